@@ -0,0 +1,641 @@
+#!/usr/bin/python3
+# 性能確認用スクリプト。ダミーのbeatoraja dbを生成して各処理の時間を計測する。
+# python benchmark.py で実行する。
+import os
+import sys
+import time
+import random
+import hashlib
+import sqlite3
+import tempfile
+import gzip
+import json
+import numpy as np
+
+SCORE_COLUMNS = ['sha256', 'mode', 'clear', 'epg', 'lpg', 'egr', 'lgr', 'egd', 'lgd', 'ebd', 'lbd', 'epr', 'lpr', 'ems', 'lms', 'notes', 'playcount', 'date']
+
+def make_dummy_db(root:str, num_songs:int, seed:int=0):
+    """beatorajaと同じテーブル構成のダミーdbを作成する。各曲を1回ずつプレーした状態にする。
+
+    Args:
+        root (str): oraja_pathとして使うフォルダ。player以下にスコア系dbを作る。
+        num_songs (int): 曲数
+        seed (int, optional): 乱数シード。 Defaults to 0.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(os.path.join(root, 'player'), exist_ok=True)
+    songs = []
+    scores = []
+    scorelogs = []
+    for i in range(num_songs):
+        sha256 = hashlib.sha256(str(i).encode()).hexdigest()
+        md5 = hashlib.md5(str(i).encode()).hexdigest()
+        notes = rnd.randint(500, 3000)
+        pg = rnd.randint(notes//2, notes)
+        gr = rnd.randint(0, notes-pg)
+        bd = (notes-pg-gr)//2
+        pr = notes-pg-gr-bd
+        date = 1700000000 + i*60
+        songs.append((md5, sha256, f'song{i}', f'/songs/{i}.bms', rnd.randint(60000, 180000), notes))
+        scores.append((sha256, 0, rnd.randint(1, 10), pg//2, pg-pg//2, gr//2, gr-gr//2, 0, 0, bd, 0, pr, 0, 0, 0, notes, 1, date))
+        scorelogs.append((sha256, 0, scores[-1][2], 0, pg*2+gr, 0, bd+pr, 999999, date))
+
+    conn = sqlite3.connect(os.path.join(root, 'songdata.db'))
+    conn.execute('CREATE TABLE song(md5 TEXT, sha256 TEXT, title TEXT, path TEXT PRIMARY KEY, length INTEGER, notes INTEGER)')
+    conn.executemany('INSERT INTO song VALUES(?,?,?,?,?,?)', songs)
+    conn.commit()
+    conn.close()
+    conn = sqlite3.connect(os.path.join(root, 'songinfo.db'))
+    conn.execute('CREATE TABLE information(sha256 TEXT PRIMARY KEY, n INTEGER)')
+    conn.commit()
+    conn.close()
+    for dbname in ('score', 'scoredatalog'):
+        conn = sqlite3.connect(os.path.join(root, 'player', f'{dbname}.db'))
+        conn.execute(f'CREATE TABLE {dbname}({",".join(SCORE_COLUMNS)})')
+        conn.executemany(f'INSERT INTO {dbname} VALUES({",".join(["?"]*len(SCORE_COLUMNS))})', scores)
+        conn.commit()
+        conn.close()
+    conn = sqlite3.connect(os.path.join(root, 'player', 'scorelog.db'))
+    conn.execute('CREATE TABLE scorelog(sha256, mode, clear, oldclear, score, oldscore, minbp, oldminbp, date)')
+    conn.executemany('INSERT INTO scorelog VALUES(?,?,?,?,?,?,?,?,?)', scorelogs)
+    conn.commit()
+    conn.close()
+
+def make_dummy_tables(root:str, num_tables:int, songs_per_table:int=5000, seed:int=0):
+    """table以下にダミーの難易度表(bmt)を作成する
+
+    Args:
+        root (str): oraja_pathとして使うフォルダ
+        num_tables (int): 難易度表の数
+        songs_per_table (int, optional): 1つの表に含まれる曲数。 Defaults to 5000.
+        seed (int, optional): 乱数シード。 Defaults to 0.
+    """
+    rnd = random.Random(seed)
+    os.makedirs(os.path.join(root, 'table'), exist_ok=True)
+    for t in range(num_tables):
+        folders = []
+        for lv in range(25):
+            songs = []
+            for i in range(songs_per_table//25):
+                key = rnd.randrange(songs_per_table*num_tables)
+                songs.append({'title':f'song{key}', 'md5':hashlib.md5(str(key).encode()).hexdigest(), 'sha256':hashlib.sha256(str(key).encode()).hexdigest(), 'artist':'dummy', 'url':'', 'comment':''})
+            folders.append({'name':f'tb{t}_{lv}', 'songs':songs})
+        with gzip.open(os.path.join(root, 'table', f'{t:03d}.bmt'), 'wt', encoding='utf-8') as f:
+            json.dump({'name':f'table{t}', 'folder':folders}, f)
+
+def create_accessor(root:str):
+    """ダミーdbを参照するDataBaseAccessorを作成する"""
+    from config import Config
+    from dataclass import DataBaseAccessor
+    config = Config(os.path.join(root, 'config.json'))
+    config.oraja_path = root
+    config.player_path = os.path.join(root, 'player')
+    config.autoload_offset = 0
+    acc = DataBaseAccessor()
+    acc.set_config(config)
+    return acc
+
+def bench_backfill(sizes=(1000, 2000, 4000, 8000)):
+    """read_old_resultsの所要時間を曲数ごとに計測する。1曲あたりの時間がほぼ一定なら線形。"""
+    print('[backfill] songs, parse[s], read_old_results[s], per song[ms]')
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as root:
+            make_dummy_db(root, n)
+            acc = create_accessor(root)
+
+            st = time.perf_counter()
+            for index,row in acc.df_score.iterrows():
+                acc.parse(row)
+            t_parse = time.perf_counter() - st
+
+            st = time.perf_counter()
+            acc.read_old_results()
+            t_all = time.perf_counter() - st
+            print(f'[backfill] {n}, {t_parse:.3f}, {t_all:.3f}, {1000*t_all/n:.3f}')
+
+def bench_difftable(num_tables=32):
+    """難易度表の読み込み時間を計測する。キャッシュ無しの逐次/並列と、キャッシュありの場合を比較する。"""
+    from dataclass import DiffTable
+    with tempfile.TemporaryDirectory() as root:
+        make_dummy_tables(root, num_tables)
+        config = type('TempConfig', (), {})()
+        config.oraja_path = root
+        config.difftable_nglist = []
+        results = {}
+        for label, max_workers, use_cache in (('serial', 1, False), ('parallel', None, False), ('cached', None, True)):
+            difftable = DiffTable()
+            difftable.cache_file = os.path.join(root, 'difftable_cache.orh')
+            if not use_cache and os.path.exists(difftable.cache_file):
+                os.remove(difftable.cache_file)
+            difftable.max_workers = max_workers
+            st = time.perf_counter()
+            difftable.set_config(config)
+            results[label] = (time.perf_counter() - st, dict(difftable.difftable))
+        assert results['serial'][1] == results['parallel'][1] == results['cached'][1]
+        print(f"[difftable] tables:{num_tables}, " + ', '.join(f"{k}:{v[0]:.3f}s" for k,v in results.items()) + f", speedup:{results['serial'][0]/results['parallel'][0]:.2f}x")
+
+def bench_xml(num_plays=400, step=100, num_songs=150, seed=0):
+    """1日にnum_plays回プレーした場合のXML出力時間を計測する。
+    1曲追加するたびにwrite_xml()する運用を想定し、プレー数が増えても1回あたりの時間がほぼ一定ならOK。
+    キャッシュを使わずに全件描画した場合と出力内容が一致することも確認する。
+    """
+    from config import Config
+    from dataclass import ManageResults, OneResult
+    rnd = random.Random(seed)
+    config = Config(os.path.join(os.getcwd(), 'config.json'))
+    config.autoload_offset = 24
+    results = ManageResults()
+    results.set_config(config)
+    now = int(time.time())
+    print('[xml] plays, write_xml[ms], full render[ms]')
+    for i in range(1, num_plays+1):
+        key = rnd.randrange(num_songs)
+        notes = 2000
+        pg = rnd.randint(1000, notes)
+        judge = [pg, notes-pg, 0, 0, 0, rnd.randint(0, 50)]
+        result = OneResult(title=f'song<{key}>&"', difficulties=[f'st{key%12}'], score=pg*2+judge[1], pre_score=rnd.randint(0, 3000),
+                           bp=judge[5], lamp=rnd.randint(1, 10), score_rate=f'{(pg*2+judge[1])/notes*50:.2f}', date=now-num_plays+i,
+                           judge=judge, sha256=hashlib.sha256(str(key).encode()).hexdigest(), length=120000, notes=notes)
+        results.add_result(result)
+        results.update_stats()
+        st = time.perf_counter()
+        results.write_xml()
+        t_write = time.perf_counter() - st
+        if i % step == 0:
+            st = time.perf_counter()
+            header = results.render_header()
+            full = (results.render_xml(header, results.today_results), results.render_xml(header, results.today_updates.values()))
+            t_full = time.perf_counter() - st
+            assert full == (results.render_history(header), results.render_updates(header))
+            print(f'[xml] {i}, {1000*t_write:.3f}, {1000*t_full:.3f}')
+
+def check_stats(num_results=300, num_songs=40, seed=0):
+    """add_result()で随時更新する集計値が、全件集計(verify_stats)と一致し続けるかを確認する。
+    重複したリザルト、オフセット外のリザルト、先月のリザルトを混ぜて1件ずつ追加する。
+    """
+    from config import Config
+    from dataclass import ManageResults, OneResult
+    rnd = random.Random(seed)
+    config = Config(os.path.join(os.getcwd(), 'config.json'))
+    config.autoload_offset = 6
+    results = ManageResults()
+    results.set_config(config)
+    now = int(time.time())
+    added = []
+    for i in range(num_results):
+        if added and rnd.random() < 0.2: # 取り込み済みのリザルトをもう一度追加する
+            result = rnd.choice(added)
+        else:
+            key = rnd.randrange(num_songs)
+            notes = 2000
+            pg = rnd.randint(1000, notes)
+            judge = [pg, notes-pg, 0, 0, 0, rnd.randint(0, 50)]
+            date = now - rnd.choice([rnd.randint(0, 3600), rnd.randint(8*3600, 20*3600), rnd.randint(40, 60)*86400]) # 今日、オフセット外、先月
+            result = OneResult(title=f'song{key}', difficulties=[], score=pg*2+judge[1], bp=judge[5], lamp=rnd.randint(1, 10),
+                               score_rate=f'{(pg*2+judge[1])/notes*50:.2f}', date=date, judge=judge,
+                               sha256=hashlib.sha256(str(key).encode()).hexdigest(), length=120000, notes=notes)
+            added.append(result)
+        results.add_result(result)
+        results.update_stats()
+        assert results.verify_stats(), (i, result.get_key())
+    print(f"[stats] results:{num_results}, all_results:{len(results.all_results)}, today_results:{len(results.today_results)}, verify_stats OK")
+
+def check_delta(num_results=3000, num_songs=10, seed=0):
+    """同じ曲を何度もプレーしてもupdates_logが曲数程度に収まり、get_delta()の差分が全件から求めたものと一致するかを確認する。
+    同じリザルトを再度追加した場合にseqが進まないことも確認する。"""
+    from config import Config
+    from dataclass import ManageResults, OneResult
+    rnd = random.Random(seed)
+    config = Config(os.path.join(os.getcwd(), 'config.json'))
+    results = ManageResults()
+    results.set_config(config)
+    now = int(time.time())
+    updated = {} # seq -> sha256
+    for i in range(num_results):
+        key = rnd.randrange(num_songs)
+        result = OneResult(title=f'song{key}', difficulties=[], score=rnd.randint(0, 4000), bp=rnd.randint(0, 50), lamp=rnd.randint(1, 10),
+                           score_rate='50.00', date=now-i, judge=[1000, 0, 0, 0, 0, 0],
+                           sha256=hashlib.sha256(str(key).encode()).hexdigest(), length=120000, notes=2000)
+        before = results.today_updates.get(result.sha256)
+        before = None if before is None else before.to_dict()
+        results.add_result(result)
+        if results.today_updates[result.sha256].to_dict() != before: # 曲ごとにまとめた結果が変化した場合のみ差分に載る
+            updated[results.seq] = result.sha256
+        seq = results.seq
+        results.add_result(result) # 同じリザルトをもう一度追加しても差分は増えない
+        assert results.seq == seq, i
+    for since in rnd.sample(sorted(updated.keys()), 100):
+        expected = {v for k,v in updated.items() if k > since}
+        delta = results.get_delta(since)
+        assert (not delta['reset']) and ({r['sha256'] for r in delta['updates']} == expected), since
+    assert len(results.updates_log) <= 2*len(results.today_updates) + 64, len(results.updates_log)
+    print(f"[delta] results:{num_results}, today_updates:{len(results.today_updates)}, updates_log:{len(results.updates_log)}, get_delta OK")
+
+def check_ingest():
+    """read_new_results()の取り込みを確認する。
+    dbが無い状態でのset_config、1回の取り込みに同じ譜面の2プレーがある場合の更新前の記録、
+    score.dbへの書き込みが遅れた場合の保留、設定の保存(set_config)を挟んだ場合の取りこぼしを確認する。
+    """
+    from config import Config
+    from dataclass import DataBaseAccessor
+
+    def play(root, key, date, score, minbp, clear, old, write_datalog=True, write_score=True):
+        """1プレー分をscoredatalog/score/scorelogに書き込む。oldは更新前の(score, minbp, clear)。"""
+        sha256 = hashlib.sha256(str(key).encode()).hexdigest()
+        pg, notes = score//2, 2000
+        row = (sha256, 0, clear, pg, 0, score-pg*2, 0, 0, 0, minbp, 0, 0, 0, 0, 0, notes, 2, date)
+        if write_datalog:
+            conn = sqlite3.connect(os.path.join(root, 'player', 'scoredatalog.db'))
+            conn.execute(f'INSERT INTO scoredatalog VALUES({",".join(["?"]*len(SCORE_COLUMNS))})', row)
+            conn.commit()
+            conn.close()
+        if write_score:
+            conn = sqlite3.connect(os.path.join(root, 'player', 'score.db'))
+            conn.execute('DELETE FROM score WHERE sha256=?', (sha256,))
+            conn.execute(f'INSERT INTO score VALUES({",".join(["?"]*len(SCORE_COLUMNS))})', row)
+            conn.commit()
+            conn.close()
+            conn = sqlite3.connect(os.path.join(root, 'player', 'scorelog.db'))
+            conn.execute('INSERT INTO scorelog VALUES(?,?,?,?,?,?,?,?,?)', (sha256, 0, clear, old[2], score, old[0], minbp, old[1], date))
+            conn.commit()
+            conn.close()
+        stamp[0] += 10 # mtimeの分解能が粗い環境でも更新を検出させる
+        for f in os.listdir(os.path.join(root, 'player')):
+            os.utime(os.path.join(root, 'player', f), (stamp[0], stamp[0]))
+
+    stamp = [time.time()]
+    with tempfile.TemporaryDirectory() as root:
+        # dbが無い状態でも起動できること
+        config = Config(os.path.join(root, 'config.json'))
+        config.oraja_path = root
+        config.player_path = os.path.join(root, 'player')
+        acc = DataBaseAccessor()
+        acc.set_config(config)
+        assert acc.read_new_results() == []
+
+        make_dummy_db(root, 5)
+        acc = create_accessor(root)
+        now = int(time.time())
+
+        # 同じ譜面を2回プレーし、どちらも自己ベストを更新した場合
+        play(root, 0, now, 1000, 50, 4, (0, 999999, 0))
+        play(root, 0, now+60, 1500, 20, 5, (1000, 50, 4))
+        assert acc.reload_db()
+        ret = acc.read_new_results()
+        assert [(r.pre_score, r.pre_bp, r.pre_lamp) for r in ret] == [(0, 999999, 0), (1000, 50, 4)], [(r.pre_score, r.pre_bp, r.pre_lamp) for r in ret]
+        rows = acc.df_scoredatalog.iloc[-2:]
+        assert [(r.pre_score, r.pre_bp, r.pre_lamp) for r in [acc.parse(row) for _,row in rows.iterrows()]] == [(0, 999999, 0), (1000, 50, 4)] # parse()も同じ値
+
+        # score.dbへの書き込みが遅れた場合は保留し、書き込まれた後に取り込む
+        conn = sqlite3.connect(os.path.join(root, 'songdata.db'))
+        conn.execute('INSERT INTO song VALUES(?,?,?,?,?,?)', (hashlib.md5(b'100').hexdigest(), hashlib.sha256(b'100').hexdigest(), 'song100', '/songs/100.bms', 120000, 2000))
+        conn.commit()
+        conn.close()
+        play(root, 100, now+120, 1200, 30, 3, (0, 999999, 0), write_score=False)
+        assert acc.reload_db()
+        assert acc.read_new_results() == []
+        play(root, 100, now+120, 1200, 30, 3, (0, 999999, 0), write_datalog=False)
+        assert acc.reload_db()
+        ret = acc.read_new_results()
+        assert [r.title for r in ret] == ['song100'], [r.title for r in ret]
+
+        # 設定の保存でset_configが呼ばれても、未処理の行を読み飛ばさない
+        play(root, 1, now+180, 1800, 10, 6, (0, 999999, 0))
+        acc.set_config(acc.config)
+        acc.reload_db()
+        ret = acc.read_new_results()
+        assert len(ret) == 1 and ret[0].title == 'song1', [r.title for r in ret]
+
+        # 取り込み中に例外が出た場合は位置を進めず、次回読み直す
+        play(root, 2, now+240, 1800, 10, 6, (0, 999999, 0))
+        acc.reload_db()
+        parse_all = acc.parse_all
+        def fail(df):
+            raise sqlite3.OperationalError('database is locked')
+        acc.parse_all = fail
+        try:
+            acc.read_new_results()
+            assert False, 'exception not raised'
+        except sqlite3.OperationalError:
+            pass
+        acc.parse_all = parse_all
+        assert acc.has_unread_results()
+        ret = acc.read_new_results()
+        assert [r.title for r in ret] == ['song2'], [r.title for r in ret]
+        assert not acc.has_unread_results()
+
+        # songdata.dbにまだ無い曲は保留し、追加された後に取り込む
+        play(root, 101, now+300, 1200, 30, 3, (0, 999999, 0))
+        acc.reload_db()
+        assert acc.read_new_results() == []
+        conn = sqlite3.connect(os.path.join(root, 'songdata.db'))
+        conn.execute('INSERT INTO song VALUES(?,?,?,?,?,?)', (hashlib.md5(b'101').hexdigest(), hashlib.sha256(b'101').hexdigest(), 'song101', '/songs/101.bms', 120000, 2000))
+        conn.commit()
+        conn.close()
+        ret = acc.read_new_results()
+        assert [r.title for r in ret] == ['song101'], [r.title for r in ret]
+    print('[ingest] set_config without db, pre records per play, deferred rows, set_config between reads, retry after errors: OK')
+
+def make_dummy_screen(width=1920, height=1080, seed=0):
+    """画面認識用のダミー画面を作成する"""
+    from PIL import Image, ImageDraw
+    rnd = random.Random(seed)
+    image = Image.new('RGB', (width, height), (20, 20, 40))
+    draw = ImageDraw.Draw(image)
+    for i in range(200):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        draw.rectangle((x, y, x+rnd.randint(10, 300), y+rnd.randint(10, 120)), fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    return image
+
+def bench_capture(repeat=20):
+    """画面認識のキャプチャ経路の時間を比較する。
+    OBS側のエンコード(jpeg)、websocketで送るbase64のサイズ、Python側のデコード+判定時間を、元の大きさ/品質100の場合と縮小/低品質の場合で計測する。
+    """
+    import base64
+    import io
+    try:
+        import imagehash
+    except ImportError:
+        print('[capture] imagehash not installed. skipped')
+        return
+    from PIL import Image
+    from obs_control import ScreenMatcher
+    screen = make_dummy_screen()
+    boxes = {'select':(100, 50, 500, 150), 'play':(1400, 900, 1800, 1000), 'result':(800, 400, 1100, 600)}
+    settings = {k:{'coordinates':{'x1':b[0], 'y1':b[1], 'x2':b[2], 'y2':b[3]}, 'hash':str(imagehash.average_hash(screen.crop(b))), 'threshold':10} for k,b in boxes.items()}
+    matcher = ScreenMatcher(settings)
+    width = matcher.get_capture_width(screen.size)
+
+    results = {}
+    for label, w, quality in (('full', None, 100), ('scaled', width, 50)):
+        t_encode = t_decode = 0
+        img = screen if w is None else screen.resize((w, round(screen.size[1]*w/screen.size[0])), Image.BILINEAR) # OBSではGPUで縮小される
+        for i in range(repeat):
+            st = time.perf_counter()
+            buf = io.BytesIO()
+            img.save(buf, 'jpeg', quality=quality)
+            payload = base64.b64encode(buf.getvalue())
+            t_encode += time.perf_counter() - st
+
+            st = time.perf_counter()
+            decoded = Image.open(io.BytesIO(base64.b64decode(payload)))
+            matched = matcher.match(decoded, screen.size if w is not None else None)
+            t_decode += time.perf_counter() - st
+        results[label] = (len(payload), 1000*t_encode/repeat, 1000*t_decode/repeat, matched)
+    assert results['full'][3] == results['scaled'][3] == ['select', 'play', 'result'], results
+    print(f"[capture] capture width:{width}")
+    for label, (size, t_encode, t_decode, matched) in results.items():
+        print(f"[capture] {label}: payload:{size/1024:.1f}KB, encode:{t_encode:.2f}ms, decode+match:{t_decode:.2f}ms")
+    print(f"[capture] payload:{results['full'][0]/results['scaled'][0]:.1f}x, encode:{results['full'][1]/results['scaled'][1]:.1f}x, decode+match:{results['full'][2]/results['scaled'][2]:.1f}x")
+
+def bench_recognition(num_frames=50):
+    """1フレームあたりの画面認識の時間を計測する。
+    imagehash.average_hashで条件ごとに比較する方法と、ScreenMatcherでまとめて比較する方法を比べ、ハミング距離が一致することも確認する。
+    元の大きさのフレームと、bench_captureと同様に縮小したフレームの両方で計測する。
+    """
+    try:
+        import imagehash
+    except ImportError:
+        print('[recognition] imagehash not installed. skipped')
+        return
+    from PIL import Image
+    from obs_control import ScreenMatcher
+    rnd = random.Random(0)
+    screens = [make_dummy_screen(seed=i) for i in range(4)]
+    boxes = {'select':(100, 50, 500, 150), 'play':(1400, 900, 1800, 1000), 'result':(800, 400, 1100, 600)}
+    settings = {k:{'coordinates':{'x1':b[0], 'y1':b[1], 'x2':b[2], 'y2':b[3]}, 'hash':str(imagehash.average_hash(screens[0].crop(b))), 'threshold':10} for k,b in boxes.items()}
+    matcher = ScreenMatcher(settings)
+    source_size = screens[0].size
+    width = matcher.get_capture_width(source_size)
+    scaled = [s.resize((width, round(source_size[1]*width/source_size[0])), Image.BILINEAR) for s in screens]
+    indices = [rnd.randrange(len(screens)) for i in range(num_frames)]
+
+    for label, images in (('full', screens), ('scaled', scaled)):
+        frames = [images[i] for i in indices]
+        sx, sy = frames[0].size[0]/source_size[0], frames[0].size[1]/source_size[1]
+        # 1条件ずつimagehashで比較する従来の方法
+        references = []
+        for k,v in settings.items():
+            box = boxes[k]
+            if label == 'scaled':
+                left, top = int(box[0]*sx), int(box[1]*sy)
+                box = (left, top, max(int(np.ceil(box[2]*sx)), left+1), max(int(np.ceil(box[3]*sy)), top+1))
+            references.append((box, imagehash.hex_to_hash(v['hash'])))
+        st = time.perf_counter()
+        expected = [[imagehash.average_hash(f.crop(box)) - ref for box, ref in references] for f in frames]
+        t_each = time.perf_counter() - st
+
+        st = time.perf_counter()
+        actual = [matcher.get_distances(f, source_size).tolist() for f in frames]
+        t_batch = time.perf_counter() - st
+        assert expected == actual
+        print(f"[recognition] {label} {frames[0].size[0]}x{frames[0].size[1]}, conditions:{len(boxes)}, per frame: imagehash:{1000*t_each/num_frames:.3f}ms, ScreenMatcher:{1000*t_batch/num_frames:.3f}ms, speedup:{t_each/t_batch:.2f}x")
+
+def bench_frame_skip(num_frames=200, seed=0):
+    """FrameChangeDetectorで変化の無いフレームのデコードと判定を省略した場合の時間とスキップ率を計測する。
+    同じ画面が続く間は、全く同じフレームと、小さなアニメーション部分だけが変わるフレームを混ぜる。
+    毎回判定した場合と認識結果が一致することも確認する。
+    """
+    import base64
+    import io
+    try:
+        import imagehash
+    except ImportError:
+        print('[frame_skip] imagehash not installed. skipped')
+        return
+    from PIL import Image, ImageDraw
+    from obs_control import ScreenMatcher, FrameChangeDetector
+    rnd = random.Random(seed)
+    screens = [make_dummy_screen(seed=i) for i in range(4)]
+    boxes = {'select':(100, 50, 500, 150), 'play':(1400, 900, 1800, 1000), 'result':(800, 400, 1100, 600)}
+    settings = {k:{'coordinates':{'x1':b[0], 'y1':b[1], 'x2':b[2], 'y2':b[3]}, 'hash':str(imagehash.average_hash(screens[i].crop(b))), 'threshold':10} for i,(k,b) in enumerate(boxes.items())}
+    matcher = ScreenMatcher(settings)
+    source_size = screens[0].size
+
+    for label, width, quality in (('full', None, 100), ('scaled', matcher.get_capture_width(source_size), 50)):
+        # OBSから届くペイロードの列を作る
+        payloads = []
+        cache = {}
+        screen_idx = 0
+        for i in range(num_frames):
+            if rnd.random() < 0.05: # 画面遷移
+                screen_idx = rnd.randrange(len(screens))
+            frame_no = rnd.randrange(4) if rnd.random() < 0.5 else 0 # 0以外はアニメーション部分だけ異なる
+            key = (screen_idx, frame_no)
+            if key not in cache.keys():
+                img = screens[screen_idx].copy()
+                ImageDraw.Draw(img).ellipse((1800, 40, 1840, 80), fill=(60*frame_no, 255, 255-60*frame_no))
+                if width is not None:
+                    img = img.resize((width, round(source_size[1]*width/source_size[0])), Image.BILINEAR)
+                buf = io.BytesIO()
+                img.save(buf, 'jpeg', quality=quality)
+                cache[key] = base64.b64encode(buf.getvalue()).decode('ascii')
+            payloads.append(cache[key])
+
+        st = time.perf_counter()
+        expected = [matcher.match(Image.open(io.BytesIO(base64.b64decode(p))), source_size) for p in payloads]
+        t_each = time.perf_counter() - st
+
+        detector = FrameChangeDetector(max_skip_time=float('inf'))
+        actual = []
+        matched = None
+        st = time.perf_counter()
+        for p in payloads:
+            data = detector.check(p)
+            if data is not None:
+                matched = matcher.match(Image.open(io.BytesIO(data)), source_size)
+            actual.append(matched)
+        t_skip = time.perf_counter() - st
+        assert expected == actual
+        metrics = detector.get_metrics()
+        print(f"[frame_skip] {label}: skip ratio:{metrics['skip_ratio']:.2f} (digest:{metrics['digest']}, thumb:{metrics['thumb']}), per frame: always decode:{1000*t_each/num_frames:.3f}ms, with early exit:{1000*t_skip/num_frames:.3f}ms, speedup:{t_each/t_skip:.2f}x")
+
+def bench_recognition_process(num_frames=60):
+    """画面認識をスレッドで行う場合とRecognitionProcessで行う場合の、メインプロセスの応答性を比べる。
+    フルサイズのフレームを連続で認識させながら、Pythonのコードだけで動く別スレッドの処理回数と1回あたりの時間を計測する。
+    両者の認識結果が一致することも確認する。
+    """
+    import base64
+    import io
+    import threading
+    try:
+        import imagehash
+    except ImportError:
+        print('[recognition_process] imagehash not installed. skipped')
+        return
+    from PIL import Image, ImageDraw
+    from obs_control import ScreenMatcher, FrameChangeDetector
+    from recognition_process import RecognitionProcess
+    screens = [make_dummy_screen(seed=i) for i in range(4)]
+    boxes = {'select':(100, 50, 500, 150), 'play':(1400, 900, 1800, 1000), 'result':(800, 400, 1100, 600)}
+    settings = {k:{'coordinates':{'x1':b[0], 'y1':b[1], 'x2':b[2], 'y2':b[3]}, 'hash':str(imagehash.average_hash(screens[i].crop(b))), 'threshold':10} for i,(k,b) in enumerate(boxes.items())}
+    payloads = []
+    for i in range(num_frames): # 毎フレーム変化させ、FrameChangeDetectorでスキップされないようにする
+        img = screens[i % len(screens)].copy()
+        ImageDraw.Draw(img).rectangle((0, 0, 1920, 1080 * (i % 7) // 7), outline=(255, 255, 255), width=40)
+        buf = io.BytesIO()
+        img.save(buf, 'jpeg', quality=100)
+        payloads.append(base64.b64encode(buf.getvalue()).decode('ascii'))
+
+    def run(recognize):
+        durations = []
+        done = threading.Event()
+        def worker(): # Pythonのコードだけで動く処理(リザルトの取り込みやTkのイベント処理の代わり)
+            while not done.is_set():
+                st = time.perf_counter()
+                sum(i*i for i in range(2000))
+                durations.append(time.perf_counter() - st)
+        th = threading.Thread(target=worker)
+        th.start()
+        st = time.perf_counter()
+        states = [recognize(p) for p in payloads]
+        elapsed = time.perf_counter() - st
+        done.set()
+        th.join()
+        durations.sort()
+        return states, elapsed, len(durations)/elapsed, durations[int(len(durations)*0.99)], durations[-1]
+
+    matcher = ScreenMatcher(settings)
+    detector = FrameChangeDetector()
+    def recognize_thread(payload):
+        data = detector.check(payload)
+        return matcher.recognize(Image.open(io.BytesIO(data)))
+    proc = RecognitionProcess()
+    assert proc.start() # 子プロセスのimportが終わるまで待つ
+    try:
+        proc.recognize(payloads[0], None, 0, settings) # 判定条件の送信と初回の判定を計測から外す
+        results = {
+            'thread': run(recognize_thread),
+            'process': run(lambda p: proc.recognize(p, None, 0, settings)[1]),
+        }
+    finally:
+        proc.stop()
+    assert results['thread'][0] == results['process'][0]
+    print(f"[recognition_process] cpu count:{os.cpu_count()}")
+    for label, (states, elapsed, rate, p99, worst) in results.items():
+        print(f"[recognition_process] {label}: recognition:{1000*elapsed/num_frames:.2f}ms/frame, other thread: {rate:.0f}ops/s, p99:{1000*p99:.2f}ms, max:{1000*worst:.2f}ms")
+
+def make_state_frames(num_songs=20, noise=0.05, seed=0):
+    """画面認識の結果を記録したような(時刻, 認識結果)の列を作る。
+    選曲→プレー→リザルト→選曲を繰り返し、遷移時のフェード(None)と、一定の割合で誤認識したフレームを混ぜる。
+    キャプチャ間隔は状態ごとに変え、誤認識したフレームの次はScreenSamplerと同様にすぐキャプチャする。
+
+    Returns:
+        tuple: (frames, 実際の遷移の列)
+    """
+    rnd = random.Random(seed)
+    durations = {'select':(10, 40), 'play':(90, 150), 'result':(5, 15)}
+    intervals = {'select':0.5, 'play':2.0, 'result':0.15}
+    frames = []
+    transitions = []
+    now = 0.0
+    prev = None
+    for state in ['select', 'play', 'result']*num_songs + ['select']:
+        transitions.append((prev, state))
+        for i in range(rnd.randint(0, 3)): # 暗転
+            frames.append((now, None))
+            now += 0.15
+        end = now + rnd.uniform(*durations[state])
+        while now < end:
+            raw = state
+            if rnd.random() < noise:
+                raw = rnd.choice([s for s in ('select', 'play', 'result', None) if s != state])
+            frames.append((now, raw))
+            now += intervals[state] if raw == state else 0.15 # 確定待ちの間はScreenSamplerが間隔を短くする
+        prev = state
+    return frames, transitions
+
+def count_commands(transitions) -> int:
+    """遷移の列から実行されるOBSのトリガー(xxx_end, xxx_start)の数を返す"""
+    return sum((old is not None) + (new is not None) for old, new in transitions)
+
+def bench_state_filter(num_songs=20, noises=(0.0, 0.02, 0.05, 0.1), num_records=10, max_exact_noise=0.05):
+    """記録した認識結果を再生し、GameStateFilterの有無で実行されるトリガーの数を比べる。
+    誤認識の割合がmax_exact_noise以下の場合は、確定した遷移が実際の遷移と一致すること(各遷移でトリガーが1回ずつ)を確認する。
+    """
+    from state_filter import GameStateFilter
+    for noise in noises:
+        num_frames = num_raw = num_filtered = num_expected = mismatches = 0
+        elapsed = 0.0
+        for seed in range(num_records):
+            frames, expected = make_state_frames(num_songs, noise, seed)
+            # フィルタ無し: 認識結果が変わるたびにトリガーを実行する
+            raw_transitions = []
+            state = None
+            for t, raw in frames:
+                if raw != state:
+                    raw_transitions.append((state, raw))
+                    state = raw
+            state_filter = GameStateFilter()
+            state_filter.reset(now=frames[0][0])
+            filtered = []
+            st = time.perf_counter()
+            for t, raw in frames:
+                transition = state_filter.update(raw, t)
+                if transition is not None:
+                    filtered.append(transition)
+            elapsed += time.perf_counter() - st
+            if noise <= max_exact_noise:
+                assert filtered == expected, (noise, seed)
+            mismatches += filtered != expected
+            num_frames += len(frames)
+            num_raw += count_commands(raw_transitions)
+            num_filtered += count_commands(filtered)
+            num_expected += count_commands(expected)
+        print(f"[state_filter] noise:{noise:.2f}, frames:{num_frames}, commands: raw:{num_raw}, filtered:{num_filtered}, expected:{num_expected}, mismatched records:{mismatches}/{num_records}, {1e6*elapsed/num_frames:.2f}us/frame")
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir) # playlog.orhやlogを作業フォルダに出力する
+    bench_backfill()
+    bench_difftable()
+    bench_xml()
+    check_stats()
+    check_delta()
+    check_ingest()
+    bench_capture()
+    bench_recognition()
+    bench_frame_skip()
+    bench_recognition_process()
+    bench_state_filter()
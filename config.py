@@ -27,6 +27,8 @@ class Config:
         self.enable_websocket = False
         self.autoload_offset = 4
         self.enable_register_conditions = True  # 画面判定条件設定機能の有効/無効
+        self.enable_overlay_server = False # overlay配信用HTTPサーバの有効/無効
+        self.overlay_server_port = 8765
 
         # ツイート機能関連
         self.enable_autotweet = False # 終了時の自動ツイート
@@ -47,6 +49,7 @@ class Config:
         self.obs_control_settings = []
         self.monitor_source_name = ""
         self.recognition_settings = {}
+        self.state_filter_settings = {} # GameStateFilterの引数(window_size, min_count, min_dwellなど)。空の場合はデフォルト値
         
         self.load_config()
     
@@ -67,6 +70,8 @@ class Config:
                     self.enable_folder_updates = config_data.get("enable_folder_updates", False)
                     self.autoload_offset = config_data.get("autoload_offset", 0)
                     self.enable_register_conditions = config_data.get("enable_register_conditions", True)
+                    self.enable_overlay_server = config_data.get("enable_overlay_server", False)
+                    self.overlay_server_port = config_data.get("overlay_server_port", 8765)
                     
                     # ウィンドウ位置設定
                     window_config = config_data.get("window", {})
@@ -81,6 +86,7 @@ class Config:
                     self.obs_control_settings = config_data.get('obs_control_settings', [])
                     self.monitor_source_name = config_data.get('monitor_source_name', "")
                     self.recognition_settings = config_data.get('recognition_settings', {})
+                    self.state_filter_settings = config_data.get('state_filter_settings', {})
             except Exception as e:
                 logger.error(traceback.format_exc())
                 print(f"設定ファイル読み込みエラー: {e}")
@@ -98,6 +104,8 @@ class Config:
             "enable_judge": self.enable_judge,
             "enable_folder_updates": self.enable_folder_updates,
             "autoload_offset": self.autoload_offset,
+            "enable_overlay_server": self.enable_overlay_server,
+            "overlay_server_port": self.overlay_server_port,
             # "enable_register_conditions": self.enable_register_conditions,
             "window": {
                 "x": self.main_window_x,
@@ -107,6 +115,7 @@ class Config:
             },
             "difftable_nglist": self.difftable_nglist,
             "obs_control_settings": self.obs_control_settings,
+            "state_filter_settings": self.state_filter_settings,
             "monitor_source_name": self.monitor_source_name,
             "recognition_settings": self.recognition_settings,
         }
@@ -2,17 +2,25 @@
 import pickle
 import json
 import gzip
+import hashlib
 import bz2
 import glob
 import datetime
 import os
 import re
 import sqlite3
+import struct
+import threading
 import pandas as pd
+import numpy as np
 import copy
+import bisect
+import time
 import webbrowser, urllib
+import urllib.request
 from config import Config
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import traceback
 
 import logging, logging.handlers
@@ -29,6 +37,23 @@ hdl.setLevel(logging.DEBUG)
 hdl_formatter = logging.Formatter('%(asctime)s %(filename)s:%(lineno)5d %(funcName)s() [%(levelname)s] %(message)s')
 hdl.setFormatter(hdl_formatter)
 logger.addHandler(hdl)
+
+def load_bmtfile(filepath:str) -> tuple:
+    """bmtファイルを読み込んでDiffTable.compile_table()の形式に変換する。
+    プロセスプールから呼べるようにモジュール直下に置いている。
+
+    Args:
+        filepath (str): bmtファイルのパス
+
+    Returns:
+        tuple: (変換結果, エラーメッセージ)。失敗した場合は変換結果がNone。
+    """
+    try:
+        with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+            return DiffTable.compile_table(json.load(f)), None
+    except Exception:
+        return None, traceback.format_exc()
+
 class DiffTable:
     """難易度表管理用クラス。table以下のgzfileのパースも行う。
     """
@@ -36,9 +61,15 @@ class DiffTable:
         self.difftable = {}
         self.songtable = {}
         self.table_names = []
-        self.tables = []
+        self.tables = [] # 読み込み対象の難易度表。{'name':表名, 'songs':[(hash, フォルダ名, 曲名), ...]}の形式
+        self.all_tables = [] # nglistに含まれるものも含めた全難易度表
         self.nglist = ['BMS Search'] # 読まないテーブル一覧。名前を登録する。
         self.config = None
+        self.cache_file = 'difftable_cache.orh' # bmtファイルのパース結果のキャッシュ
+        self.bmt_cache = None # bmtファイルのパス -> {'sig':(mtime, size), 'table':パース結果}
+        self.tables_signature = None # 前回update_tables()した時の対象ファイル。変化がなければ辞書を作り直さない
+        self.max_workers = None # bmtファイルを並列に読む際のプロセス数。Noneの場合はCPU数、1の場合は並列化しない
+        self.parallel_min_files = 4 # 読み込むファイルがこれ未満なら並列化しない
         
         # デフォルト設定で初期化を試行
         try:
@@ -64,7 +95,8 @@ class DiffTable:
                 return
         
         self.config = config
-        self.nglist = list(set(self.nglist + getattr(config, 'difftable_nglist', [])))
+        # 設定画面で有効に戻された表も反映されるよう、毎回デフォルト+configから作り直す
+        self.nglist = list(set(['BMS Search'] + getattr(config, 'difftable_nglist', [])))
         
         # oraja_pathが設定されていない場合は空の状態で初期化
         if not hasattr(config, 'oraja_path') or not config.oraja_path:
@@ -73,6 +105,7 @@ class DiffTable:
             self.tables = []
             self.difftable = {}
             self.songtable = {}
+            self.tables_signature = None
             return
         
         try:
@@ -86,6 +119,7 @@ class DiffTable:
             self.tables = []
             self.difftable = {}
             self.songtable = {}
+            self.tables_signature = None
 
     def parse_gzfile_to_json(self, filepath) -> json:
         """bmt(gz)ファイルからjsonへパース
@@ -99,23 +133,66 @@ class DiffTable:
         with gzip.open(filepath, 'rt', encoding='utf-8') as f:
             return json.load(f)
 
+    @staticmethod
+    def compile_table(table:dict) -> dict:
+        """bmtファイルのパース結果から必要な情報だけを取り出す
+
+        Args:
+            table (dict): parse_gzfile_to_json()の結果
+
+        Returns:
+            dict: {'name':表名, 'songs':[(hash, フォルダ名, 曲名), ...]}。読み込み元は呼び出し側で'file'に登録する。
+        """
+        songs = []
+        for f in table.get('folder', []):
+            for song in f.get('songs', []):
+                md5 = song.get('sha256') or song.get('md5')
+                if md5:  # md5/sha256が存在する場合のみ処理
+                    songs.append((md5, f.get('name', 'Unknown'), song.get('title', 'Unknown')))
+        return {'name':table.get('name', 'Unknown'), 'songs':songs}
+
+    def load_cache(self) -> dict:
+        """bmtファイルのパース結果のキャッシュを読み込む
+
+        Returns:
+            dict: bmtファイルのパス -> {'sig':(mtime, size), 'table':compile_table()の結果}
+        """
+        if self.bmt_cache is None:
+            try:
+                with open(self.cache_file, 'rb') as f:
+                    self.bmt_cache = pickle.load(f)
+            except Exception:
+                self.bmt_cache = {}
+        return self.bmt_cache
+
+    def save_cache(self):
+        """bmtファイルのパース結果のキャッシュを保存する"""
+        try:
+            tmp_file = self.cache_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(self.bmt_cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file)
+        except Exception:
+            logger.error(traceback.format_exc())
+
     def parse_bmtfiles(self):
-        """bmtファイルをパースして難易度表データを構築"""
+        """bmtファイルをパースして難易度表データを構築。
+        (パス, 更新時刻, サイズ)が前回と同じファイルはキャッシュを使い、変更されたものだけパースする。
+        """
         if not self.config or not self.config.oraja_path:
             print("設定が不正です。難易度表をパースできません。")
-            self.tables = []
-            self.table_names = []
+            self.all_tables = []
+            self.filter_tables()
             return
         
-        tables = [] 
-        table_names = []
+        all_tables = []
         
         # tableディレクトリの存在確認
         table_dir = os.path.join(self.config.oraja_path, 'table')
         if not os.path.exists(table_dir):
             print(f"難易度表ディレクトリが見つかりません: {table_dir}")
-            self.tables = []
-            self.table_names = []
+            self.all_tables = []
+            self.filter_tables()
             return
         
         # bmtファイルを検索してパース
@@ -125,27 +202,78 @@ class DiffTable:
         if not bmt_files:
             print(f"bmtファイルが見つかりません: {bmt_pattern}")
         
+        cache = self.load_cache()
+        cache_updated = False
+        sigs = {}
         for f in bmt_files:
             try:
-                tmp = self.parse_gzfile_to_json(f)
-                table_name = tmp.get('name', 'Unknown')
-                
-                # BMS Searchは常に除外
-                if 'BMS Search' not in table_name:
-                    table_names.append(table_name)
-                
-                # nglistに含まれていない場合のみ追加
-                if table_name not in self.nglist:
-                    tables.append(tmp)
-                    print(f"難易度表を読み込み: {table_name}")
-                else:
-                    print(f"難易度表をスキップ: {table_name} (nglistに含まれています)")
-                    
+                st = os.stat(f)
+                sigs[f] = (st.st_mtime, st.st_size)
             except Exception as e:
                 logger.error(traceback.format_exc())
                 print(f"bmtファイル読み込みエラー ({f}): {e}")
+        targets = [f for f in sigs.keys() if (f not in cache.keys()) or (cache[f]['sig'] != sigs[f])]
+        for f, (table, err) in zip(targets, self.load_bmtfiles(targets)):
+            if table is None:
+                logger.error(err)
+                print(f"bmtファイル読み込みエラー ({f})")
                 continue
-        
+            table['file'] = (f, sigs[f])
+            cache[f] = {'sig':sigs[f], 'table':table}
+            cache_updated = True
+        # 並列に読んだ場合も、glob順に並べることで結果を逐次処理と同じにする
+        for f in sigs.keys():
+            if (f in cache.keys()) and (cache[f]['sig'] == sigs[f]):
+                all_tables.append(cache[f]['table'])
+
+        # 消えたファイルのキャッシュは削除(他のoraja_pathのものは残す)
+        for f in list(cache.keys()):
+            if os.path.dirname(f) == os.path.dirname(bmt_pattern) and f not in bmt_files:
+                cache.pop(f)
+                cache_updated = True
+        if cache_updated:
+            self.save_cache()
+
+        self.all_tables = all_tables
+        self.filter_tables()
+
+    def load_bmtfiles(self, files:list) -> list:
+        """複数のbmtファイルを読み込む。ファイル数が多い場合はプロセスプールで並列に処理する。
+
+        Args:
+            files (list): bmtファイルのパスの配列
+
+        Returns:
+            list: filesと同じ順のload_bmtfile()の結果
+        """
+        if (self.max_workers == 1) or (len(files) < self.parallel_min_files):
+            return [load_bmtfile(f) for f in files]
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                return list(executor.map(load_bmtfile, files)) # mapは入力順に結果を返す
+        except Exception:
+            # プロセスを起動できない環境では逐次処理にフォールバック
+            logger.error(traceback.format_exc())
+            return [load_bmtfile(f) for f in files]
+
+    def filter_tables(self):
+        """all_tablesからnglistに含まれるものを除いてself.tablesに登録する"""
+        tables = []
+        table_names = []
+        for t in self.all_tables:
+            table_name = t['name']
+
+            # BMS Searchは常に除外
+            if 'BMS Search' not in table_name:
+                table_names.append(table_name)
+
+            # nglistに含まれていない場合のみ追加
+            if table_name not in self.nglist:
+                tables.append(t)
+                print(f"難易度表を読み込み: {table_name}")
+            else:
+                print(f"難易度表をスキップ: {table_name} (nglistに含まれています)")
+
         self.tables = tables
         self.table_names = sorted(list(set(table_names)))  # 重複を除去してソート
         print(f"合計 {len(self.table_names)} 個の難易度表を認識しました")
@@ -155,31 +283,28 @@ class DiffTable:
         for name in ng:
             if name not in self.nglist:
                 self.nglist.append(name)
-        # 再パースして更新
+        # パース済みのものをフィルタして更新
         if self.config:
-            self.parse_bmtfiles()
+            self.filter_tables()
             self.update_tables()
 
     def update_tables(self):
+        # 対象の難易度表が前回と同じなら作り直さない
+        signature = [t['file'] for t in self.tables]
+        if signature == self.tables_signature:
+            return
         print(f'難易度表管理用dictを更新します')
         songtable = {} # hash to (difficulty,title)
         difftable = defaultdict(list)
 
         for t in self.tables:
-            try:
-                for f in t.get('folder', []):
-                    for song in f.get('songs', []):
-                        md5 = song.get('sha256') or song.get('md5')
-                        if md5:  # md5/sha256が存在する場合のみ処理
-                            difftable[md5].append(f.get('name', 'Unknown'))
-                            songtable[md5] = (f.get('name', 'Unknown'), song.get('title', 'Unknown'))
-            except Exception as e:
-                logger.error(traceback.format_exc())
-                print(f"難易度表処理エラー: {e}")
-                continue
+            for md5, folder, title in t['songs']:
+                difftable[md5].append(folder)
+                songtable[md5] = (folder, title)
                 
         self.songtable = songtable
         self.difftable = difftable
+        self.tables_signature = signature
         print(f"難易度表辞書を構築しました (楽曲数: {len(songtable)})")
 
     def search_from_hash(self, hash:str) -> list:
@@ -279,9 +404,135 @@ class OneResult:
         out['date']      = self.date
         return pd.DataFrame(out, index=[0])
     
+    def to_dict(self) -> dict:
+        """JSONに変換できる形式で返す。overlayへの通知用。
+        scorelogが無いなどで値がNaNの場合はNoneにする(ブラウザのJSON.parseはNaNを受け付けないため)。"""
+        def conv(x):
+            x = x.item() if hasattr(x, 'item') else x
+            return None if (isinstance(x, float) and (x != x)) else x
+        return {
+            'title':self.title,
+            'sha256':self.sha256,
+            'difficulties':list(self.difficulties or []),
+            'lamp':conv(self.lamp),
+            'pre_lamp':conv(self.pre_lamp),
+            'score':conv(self.score),
+            'pre_score':conv(self.pre_score),
+            'bp':conv(self.bp),
+            'pre_bp':conv(self.pre_bp),
+            'score_rate':self.score_rate,
+            'notes':conv(self.notes),
+            'judge':[conv(j) for j in self.judge] if self.judge is not None else None,
+            'date':conv(self.date),
+        }
+
     def is_valid(self):
         return (self.title is not None) and (self.judge is not None) and (self.sha256 is not None)
 
+    def get_key(self) -> tuple:
+        """重複判定用のキーを返す。ManageResultsでsetに登録して使う。
+
+        Returns:
+            tuple: (sha256, date, score, bp, lamp)
+        """
+        return (self.sha256, self.date, self.score, self.bp, self.lamp)
+
+class DailyStats:
+    """日ごとの集計値(プレー数、ノーツ数、判定内訳、フォルダごとのランプ更新数)を管理するクラス。
+    月別・年別の統計をall_resultsを走査せずに出すために使う。
+    """
+    def __init__(self):
+        self.days = {} # 'YYYY/MM/DD' -> {'plays', 'notes', 'judge', 'lamp_updates'}
+        self.num_results = 0 # 登録したリザルト数。all_resultsとの整合チェックに使う
+        self.updated = False # 前回のsave()以降に更新があればTrue
+
+    def add(self, result:OneResult):
+        """リザルト1件分を該当日の集計値に加算する
+
+        Args:
+            result (OneResult): 追加するリザルト
+        """
+        self.num_results += 1
+        self.updated = True
+        if not result.is_valid():
+            return
+        ts = datetime.datetime.fromtimestamp(result.date)
+        key = f"{ts.year}/{ts.month:02d}/{ts.day:02d}"
+        if key not in self.days.keys():
+            self.days[key] = {'plays':0, 'notes':0, 'judge':[0, 0, 0, 0, 0, 0], 'lamp_updates':{}}
+        day = self.days[key]
+        day['plays'] += 1
+        for i in range(6):
+            day['judge'][i] += int(result.judge[i])
+        day['notes'] += sum(map(int, result.judge[:5]))
+        if result.lamp >= 4 and result.lamp > result.pre_lamp: # 更新した曲
+            for d in (result.difficulties or []):
+                if d not in day['lamp_updates'].keys():
+                    day['lamp_updates'][d] = [0]*11
+                day['lamp_updates'][d][int(result.lamp)] += 1
+
+    def rebuild(self, results:list):
+        """全リザルトから集計し直す
+
+        Args:
+            results (list): OneResultの配列
+        """
+        self.days = {}
+        self.num_results = 0
+        for r in results:
+            self.add(r)
+
+    def summarize(self, key_length:int) -> dict:
+        """日ごとの判定内訳を期間ごとにまとめる。
+
+        Args:
+            key_length (int): 日付キーの先頭何文字でまとめるか。月別なら7('YYYY/MM')、年別なら4('YYYY')。
+
+        Returns:
+            dict: 期間 -> 判定内訳。期間の昇順。
+        """
+        ret = {}
+        for key in sorted(self.days.keys()):
+            period = key[:key_length]
+            if period not in ret.keys():
+                ret[period] = [0, 0, 0, 0, 0, 0]
+            for i in range(6):
+                ret[period][i] += self.days[key]['judge'][i]
+        return ret
+
+    def save(self, filename:str):
+        """更新があればファイルに保存する
+
+        Args:
+            filename (str): 出力先
+        """
+        if not self.updated:
+            return
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'num_results':self.num_results, 'days':self.days}, f)
+        os.replace(tmp_file, filename)
+        self.updated = False
+
+    def load(self, filename:str, results:list):
+        """ファイルから読み込む。ファイルが無いか件数がresultsと合わない場合は作り直す。
+
+        Args:
+            filename (str): 入力ファイル
+            results (list): 整合チェック用のOneResultの配列
+        """
+        try:
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+            self.days = data['days']
+            self.num_results = data['num_results']
+            self.updated = False
+        except Exception:
+            self.num_results = -1
+        if self.num_results != len(results):
+            logger.info(f"daily stats rebuilt. ({self.num_results} -> {len(results)})")
+            self.rebuild(results)
+
 class ManageResults:
     """OneResultの配列を管理するクラス。xml出力とかもやる。
     """
@@ -290,10 +541,38 @@ class ManageResults:
         self.all_results = [] # oraja_helperで記録した全てのログ。orhファイルへの保存対象。
         self.today_results = [] # resultsに対して日付でフィルタリングしたもの
         self.today_updates = {} # resultsは全て記録するが、こちらは同じ曲ならマージする
+        self.all_keys = set() # all_resultsの重複判定用。OneResult.get_key()を登録する
+        self.today_keys = set() # today_resultsの重複判定用
         self.start_time = datetime.datetime.now()
         self.playtime = datetime.timedelta(seconds=0)
         self.notes = 0
+        self.today_judge = [0, 0, 0, 0, 0, 0] # today_resultsの判定の合計
+        self.notes_month = 0 # start_timeと同じ月のノーツ数
+        self.stats_dirty = True # Trueの場合、次のupdate_stats()で全件から集計し直す
+        self.check_stats_consistency = False # Trueの場合、update_stats()のたびに全件集計と比較する(デバッグ用)
         self.config = None
+        self.playlog_file = 'playlog.orh' # compaction済みの全リザルト(bz2+pickle)
+        self.journal_file = 'playlog_journal.orh' # playlog.orh以降のリザルトを1件ずつ追記するファイル
+        self.daily_file = 'playlog_daily.orh' # 日ごとの集計値
+        self.daily_stats = DailyStats()
+        self.compact_threshold = 200 # journalがこの件数を超えたらcompactionする
+        self.journal_records = 0 # journalに入っている件数
+        self.pending_results = [] # まだjournalに書き出していないリザルト
+        self.file_lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.escape_cache = {} # タイトル -> XML用にエスケープしたタイトル
+        self.output_hash = {} # 出力ファイル -> 前回書き出した内容のハッシュ
+        self.history_fragments = {} # today_resultsの各リザルトの<Result>要素。OneResult.get_key()をキーとする
+        self.updates_fragments = {} # today_updatesの各エントリの<Result>要素。sha256をキーとし、マージで変化したら消す
+        self.output_lock = threading.Lock()
+        self.listeners = [] # リザルト追加時やXML更新時に呼ぶ関数。func(event, data)の形式
+        self.notify_results = True # Falseの間はadd_result()で'result'を通知しない(起動時の一括読み込み用)
+        self.seq = 0 # today_results/today_updatesが変化するたびに増える番号。get_delta()で差分を返すのに使う
+        self.base_seq = 0 # init_today_results()した時点のseq。これより前を指定された場合は全件返す
+        self.history_seq = [] # today_resultsの各要素を追加した時のseq
+        self.updates_seq = [] # today_updatesを更新した時のseq
+        self.updates_log = [] # updates_seqに対応するsha256
+        self.delta_lock = threading.Lock()
         self.load()
         self.save()
 
@@ -314,51 +593,256 @@ class ManageResults:
         self.update_stats()
 
     def save(self):
-        """self.all_resultsをファイルに保存する
+        """未保存のリザルトをjournalに追記する。
+        journalが大きくなった場合はバックグラウンドでcompactionを行う。
+        """
+        with self.file_lock:
+            self.append_journal()
+            self.daily_stats.save(self.daily_file)
+            need_compact = (not os.path.exists(self.playlog_file)) or (self.journal_records >= self.compact_threshold)
+        logger.info(f"number of results: {len(self.all_results)}, journal: {self.journal_records}")
+        if need_compact:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def append_journal(self):
+        """self.pending_resultsをjournalに追記する。file_lockを取った状態で呼ぶこと。
+        1件ごとに4byteの長さ+pickleの形式で書き込む。
+        """
+        if len(self.pending_results) == 0:
+            return
+        with open(self.journal_file, 'ab') as f:
+            for r in self.pending_results:
+                data = pickle.dumps(r)
+                f.write(struct.pack('<I', len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_records += len(self.pending_results)
+        self.pending_results = []
+
+    def compact(self):
+        """all_resultsをplaylog.orhに書き出し、書き出した分をjournalから消す。
+        書き込みは一時ファイル経由で行い、途中で落ちても元のファイルが壊れないようにしている。
         """
-        logger.info(f"number of results: {len(self.all_results)}")
-        with bz2.BZ2File('playlog.orh', 'wb', compresslevel=9) as f:
-            pickle.dump(self.all_results, f)
+        with self.compact_lock:
+            with self.file_lock:
+                self.append_journal()
+                self.daily_stats.save(self.daily_file)
+                results = list(self.all_results)
+                journal_size = os.path.getsize(self.journal_file) if os.path.exists(self.journal_file) else 0
+                journal_records = self.journal_records
+            tmp_file = self.playlog_file + '.tmp'
+            with bz2.BZ2File(tmp_file, 'wb', compresslevel=9) as f:
+                pickle.dump(results, f)
+            os.replace(tmp_file, self.playlog_file)
+
+            with self.file_lock:
+                # compaction中に追記された分だけjournalに残す
+                if os.path.exists(self.journal_file):
+                    with open(self.journal_file, 'rb') as f:
+                        f.seek(journal_size)
+                        rest = f.read()
+                    tmp_file = self.journal_file + '.tmp'
+                    with open(tmp_file, 'wb') as f:
+                        f.write(rest)
+                    os.replace(tmp_file, self.journal_file)
+                self.journal_records -= journal_records
+            logger.info(f"compaction done. number of results: {len(results)}")
 
     def load(self):
-        try:
-            with bz2.BZ2File('playlog.orh', 'rb', compresslevel=9) as f:
-                self.all_results = pickle.load(f)
-        except:
-            logger.error(traceback.format_exc())
+        """playlog.orhを読み込み、journalに追記されたリザルトを反映する。
+        旧バージョンのplaylog.orh(journal無し)もそのまま読み込める。
+        """
+        with self.file_lock:
+            self.append_journal() # 未保存のものは先に書き出しておく
+            try:
+                with bz2.BZ2File(self.playlog_file, 'rb', compresslevel=9) as f:
+                    self.all_results = pickle.load(f)
+            except:
+                logger.error(traceback.format_exc())
+            self.all_keys = set(r.get_key() for r in self.all_results)
+            self.stats_dirty = True
+            self.journal_records = 0
+            if os.path.exists(self.journal_file):
+                self.replay_journal()
+            self.daily_stats.load(self.daily_file, self.all_results)
+
+    def replay_journal(self):
+        """journalに追記されたリザルトをall_resultsに反映する。file_lockを取った状態で呼ぶこと。
+        """
+        with open(self.journal_file, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos+4 <= len(data):
+            size = struct.unpack_from('<I', data, pos)[0]
+            if pos+4+size > len(data):
+                break
+            try:
+                r = pickle.loads(data[pos+4:pos+4+size])
+            except Exception:
+                logger.error(traceback.format_exc())
+                break
+            pos += 4+size
+            self.journal_records += 1
+            # compaction直後に落ちた場合はplaylog.orhと重複するので除外する
+            if r.get_key() not in self.all_keys:
+                self.all_keys.add(r.get_key())
+                self.all_results.append(r)
+        if pos < len(data):
+            # 書き込み途中で落ちた場合、壊れた末尾を切り捨てる
+            logger.warning(f"journal is broken. truncated: {len(data)} -> {pos}")
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(pos)
+
+    def add_listener(self, func):
+        """リザルト追加(event='result')やXML更新(event='update')を通知する関数を登録する
+
+        Args:
+            func (function): func(event:str, data:dict)の形式の関数
+        """
+        if func not in self.listeners:
+            self.listeners.append(func)
+
+    def remove_listener(self, func):
+        if func in self.listeners:
+            self.listeners.remove(func)
+
+    def notify(self, event:str, data:dict):
+        for func in list(self.listeners):
+            try:
+                func(event, data)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    def get_stats(self) -> dict:
+        """XMLのヘッダ部分と同じ統計情報を返す"""
+        return {
+            'date':f"{self.start_time.year}/{self.start_time.month:02d}/{self.start_time.day:02d}",
+            'notes':self.notes,
+            'notes_month':self.notes_month,
+            'total_score_rate':f"{self.score_rate:.2f}",
+            'playcount':self.playcount,
+            'playtime':str(self.playtime).split(".")[0] if self.playtime.seconds > 0 else '0',
+            'pace':int(3600*self.notes/self.playtime.seconds) if self.playtime.seconds > 0 else 0,
+        }
+
+    def get_delta(self, since:int=None) -> dict:
+        """指定したseqより後に追加・変化したリザルトと、現在の統計情報を返す。overlayのJSON APIで使う。
+
+        Args:
+            since (int, optional): クライアントが前回受け取ったseq。Noneの場合や古すぎる場合は全件返す。 Defaults to None.
+
+        Returns:
+            dict: {'seq':現在のseq, 'reset':全件を返した場合True, 'stats':統計情報, 'history':today_resultsの差分, 'updates':today_updatesの差分}
+        """
+        with self.delta_lock:
+            reset = (since is None) or (since < self.base_seq) or (since > self.seq)
+            if reset:
+                history = list(self.today_results)
+                updates = list(self.today_updates.values())
+            else:
+                history = self.today_results[bisect.bisect_right(self.history_seq, since):]
+                changed = dict.fromkeys(self.updates_log[bisect.bisect_right(self.updates_seq, since):]) # 同じ曲は1回だけ返す
+                updates = [self.today_updates[k] for k in changed.keys()]
+            ret = {
+                'seq':self.seq,
+                'reset':reset,
+                'stats':self.get_stats(),
+                'history':[r.to_dict() for r in history if r.is_valid()],
+                'updates':[r.to_dict() for r in updates if r.is_valid()],
+            }
+        return ret
+
+    def compact_updates_log(self):
+        """updates_seq/updates_logを曲ごとに最後に更新したseqだけにする。delta_lockを取った状態で呼ぶこと。
+        sinceより後に更新された曲は最後の更新もsinceより後なので、get_delta()の結果は変わらない。
+        同じ曲を何度もプレーしてもtoday_updatesの曲数程度に収まる。
+        """
+        last = dict(zip(self.updates_log, self.updates_seq)) # 後の要素で上書きされる
+        items = sorted(last.items(), key=lambda x:x[1])
+        self.updates_log = [k for k,v in items]
+        self.updates_seq = [v for k,v in items]
 
     def init_today_results(self):
         """起動時の初回登録用メソッド。self.all_resultsからtoday_results/updatesに条件を満たすものを登録する
         """
-        self.today_results = []
-        self.today_updates = {}
-        for r in self.all_results:
-            if r.is_valid():
-                if r.date > int(self.start_time.timestamp()) - self.config.autoload_offset*3600:
-                    if r not in self.today_results:
-                        self.today_results.append(r)
-                    if r.sha256 not in self.today_updates.keys():
-                        self.today_updates[r.sha256] = r
-                    else:
-                        self.today_updates[r.sha256] += r
+        with self.delta_lock:
+            self.today_results = []
+            self.today_updates = {}
+            self.today_keys = set()
+            self.history_fragments = {}
+            self.updates_fragments = {}
+            self.stats_dirty = True
+            for r in self.all_results:
+                if r.is_valid():
+                    if r.date > int(self.start_time.timestamp()) - self.config.autoload_offset*3600:
+                        if r.get_key() not in self.today_keys:
+                            self.today_keys.add(r.get_key())
+                            self.today_results.append(r)
+                        if r.sha256 not in self.today_updates.keys():
+                            self.today_updates[r.sha256] = r
+                        else:
+                            self.today_updates[r.sha256] += r
+            self.seq += 1
+            self.base_seq = self.seq
+            self.history_seq = [self.seq] * len(self.today_results)
+            self.updates_seq = [self.seq] * len(self.today_updates)
+            self.updates_log = list(self.today_updates.keys())
 
-    def update_stats(self):
-        """統計情報(ノーツ数やスコアレート)を更新
+    def is_this_month(self, result:OneResult) -> bool:
+        """リザルトがstart_timeと同じ月のものかどうかを返す"""
+        result_date = datetime.datetime.fromtimestamp(result.date)
+        return (result_date.month == self.start_time.month) and (result_date.year == self.start_time.year)
+
+    def calc_stats(self, full:bool=False) -> tuple:
+        """today_resultsを走査して集計値を計算する。今月のノーツ数は日ごとの集計値から求める。
+
+        Args:
+            full (bool, optional): Trueの場合は今月のノーツ数もall_resultsを全件走査して求める。 Defaults to False.
+
+        Returns:
+            tuple: (today_resultsの判定の合計, 今月のノーツ数)
         """
         sum_judge = [0, 0, 0, 0, 0, 0]
-        # offsetの条件を満たすものだけ抽出
-
         for r in self.today_results:
             for i in range(6):
                 sum_judge[i] += r.judge[i]
+        notes_month = 0
+        if full:
+            for r in self.all_results:
+                if self.is_this_month(r):
+                    for i in range(5):
+                        notes_month += r.judge[i]
+        else:
+            judge_month = self.daily_stats.summarize(7).get(f"{self.start_time.year}/{self.start_time.month:02d}")
+            if judge_month:
+                notes_month = sum(judge_month[:5])
+        return sum_judge, notes_month
+
+    def verify_stats(self) -> bool:
+        """add_result()で更新してきた集計値が全件集計と一致するか確認する。
+
+        Returns:
+            bool: 一致すればTrue
+        """
+        sum_judge, notes_month = self.calc_stats(full=True)
+        ret = (list(sum_judge) == list(self.today_judge)) and (notes_month == self.notes_month)
+        if not ret:
+            logger.error(f"stats mismatch! judge:{self.today_judge} -> {sum_judge}, notes_month:{self.notes_month} -> {notes_month}")
+        return ret
+
+    def update_stats(self):
+        """統計情報(ノーツ数やスコアレート)を更新。
+        判定の合計や月間ノーツ数はadd_result()で随時加算しているので、
+        load()やinit_today_results()の後だけ全件から集計し直す。
+        """
+        if self.stats_dirty:
+            self.today_judge, self.notes_month = self.calc_stats()
+            self.stats_dirty = False
+        elif self.check_stats_consistency:
+            self.verify_stats()
+        sum_judge = self.today_judge
         self.score_rate = 0 # total
         self.notes = sum_judge[0]+sum_judge[1]+sum_judge[2]+sum_judge[3]+sum_judge[4]
-        self.notes_month = 0
-        for r in reversed(self.all_results):
-            result_date = datetime.datetime.fromtimestamp(r.date)
-            if (result_date.month == self.start_time.month) and (result_date.year == self.start_time.year):
-                for i in range(5):
-                    self.notes_month += r.judge[i]
         if (self.notes) > 0:
             self.score_rate = 100*(sum_judge[0]*2+sum_judge[1]) / (sum_judge[0]+sum_judge[1]+sum_judge[2]+sum_judge[3]+sum_judge[4]) / 2
         self.playcount = len(self.today_results)
@@ -391,109 +875,184 @@ class ManageResults:
             result (OneResult): _description_
         """
         logger.info(f"add_result() called. title:{result.title}")
-        if result not in self.all_results:
-            self.all_results.append(result)
+        if result.get_key() not in self.all_keys:
+            with self.file_lock:
+                self.all_keys.add(result.get_key())
+                self.all_results.append(result)
+                self.pending_results.append(result)
+                self.daily_stats.add(result)
+            if self.is_this_month(result):
+                for i in range(5):
+                    self.notes_month += result.judge[i]
             logger.debug(f"all_results updated! -> len:{len(self.all_results)}")
         if result.date > int(self.start_time.timestamp()) - self.config.autoload_offset*3600:
             logger.debug(f"offset check passed")
-            if result not in self.today_results:
-                self.today_results.append(result)
-                logger.debug(f"today_results updated! -> len:{len(self.today_results)}")
-            if result.sha256 not in self.today_updates.keys():
-                self.today_updates[result.sha256] = result
-            else:
-                self.today_updates[result.sha256] += result
+            with self.delta_lock:
+                # 取り込み済みのリザルトと同じで何も変わらない場合はseqを進めず、差分にも載せない
+                is_new = result.get_key() not in self.today_keys
+                old = self.today_updates.get(result.sha256)
+                merged = result if old is None else old + result
+                updated = (old is None) or (merged.to_dict() != old.to_dict())
+                if is_new or updated:
+                    self.seq += 1
+                if is_new:
+                    self.today_keys.add(result.get_key())
+                    self.today_results.append(result)
+                    self.history_seq.append(self.seq)
+                    for i in range(6):
+                        self.today_judge[i] += result.judge[i]
+                    logger.debug(f"today_results updated! -> len:{len(self.today_results)}")
+                if updated:
+                    self.today_updates[result.sha256] = merged
+                    self.updates_fragments.pop(result.sha256, None)
+                    self.updates_seq.append(self.seq)
+                    self.updates_log.append(result.sha256)
+                    if len(self.updates_log) > 2*len(self.today_updates) + 64:
+                        self.compact_updates_log()
+        if self.listeners and self.notify_results:
+            self.notify('result', result.to_dict())
 
-    def write_history_xml(self, outfile='history.xml'):
-        with open(outfile, 'w', encoding='utf-8') as f:
-            f.write(f'<?xml version="1.0" encoding="utf-8"?>\n')
-            f.write("<Items>\n")
-            f.write(f"    <date>{self.start_time.year}/{self.start_time.month:02d}/{self.start_time.day:02d}</date>\n")
-            f.write(f'    <notes>{self.notes}</notes>\n')
-            f.write(f'    <notes_month>{self.notes_month}</notes_month>\n')
-            f.write(f'    <total_score_rate>{self.score_rate:.2f}</total_score_rate>\n')
-            f.write(f'    <playcount>{self.playcount}</playcount>\n')
-            # f.write(f'    <last_notes>{self.last_notes}</last_notes>\n')
-            if self.playtime.seconds == 0:
-                f.write(f'    <playtime>0</playtime>\n') # HTML側で処理しやすくしている
-                f.write(f'    <pace>0</pace>\n')
-            else:
-                f.write(f'    <playtime>{str(self.playtime).split(".")[0]}</playtime>\n')
-                f.write(f'    <pace>{int(3600*self.notes/self.playtime.seconds)}</pace>\n')
+    def escape_title(self, title:str) -> str:
+        """XML用にエスケープしたタイトルを返す。同じ曲は何度も出力されるのでキャッシュしておく。"""
+        if title not in self.escape_cache.keys():
+            self.escape_cache[title] = title.replace('&', '&amp;').replace('<','&lt;').replace('>','&gt;').replace('"','&quot;').replace("'",'&apos;')
+        return self.escape_cache[title]
 
-            for r in self.today_results:
-                if not r.is_valid():
-                    logger.debug(f"invalid data! skipped")
-                    continue
-                title_esc = r.title.replace('&', '&amp;').replace('<','&lt;').replace('>','&gt;').replace('"','&quot;').replace("'",'&apos;')
-                f.write(f'    <Result>\n')
-                # f.write(f'        <lv>{r.difficulties[0]}</lv>\n')
-                f.write(f'        <lv>{",".join(r.difficulties)}</lv>\n')
-                f.write(f'        <title>{title_esc}</title>\n')
-                f.write(f'        <lamp>{r.lamp}</lamp>\n')
-                f.write(f'        <pre_lamp>{r.pre_lamp}</pre_lamp>\n')
-                f.write(f'        <score>{r.score}</score>\n')
-                f.write(f'        <pre_score>{r.pre_score}</pre_score>\n')
-                f.write(f'        <bp>{r.bp}</bp>\n')
-                f.write(f'        <pre_bp>{r.pre_bp}</pre_bp>\n')
-                if r.pre_score > 0:
-                    f.write(f'        <diff_score>{r.score-r.pre_score:+}</diff_score>\n')
-                else: # 初プレイ時は空白
-                    f.write(f'        <diff_score></diff_score>\n')
-                if r.pre_bp < 100000:
-                    f.write(f'        <diff_bp>{r.bp-r.pre_bp:+}</diff_bp>\n')
-                else: # 初プレイ時は空白
-                    f.write(f'        <diff_bp></diff_bp>\n')
-                f.write(f'        <score_rate>{float(r.score_rate):.2f}</score_rate>\n')
-                f.write(f'        <timestamp>{datetime.datetime.fromtimestamp(r.date)}</timestamp>\n')
-                f.write('    </Result>\n')
-            f.write("</Items>\n")
+    def render_header(self) -> str:
+        """history.xml/updates.xmlで共通のヘッダ部分(統計情報)を返す"""
+        out = []
+        out.append(f'<?xml version="1.0" encoding="utf-8"?>\n')
+        out.append("<Items>\n")
+        out.append(f"    <date>{self.start_time.year}/{self.start_time.month:02d}/{self.start_time.day:02d}</date>\n")
+        out.append(f'    <notes>{self.notes}</notes>\n')
+        out.append(f'    <notes_month>{self.notes_month}</notes_month>\n')
+        out.append(f'    <total_score_rate>{self.score_rate:.2f}</total_score_rate>\n')
+        out.append(f'    <playcount>{self.playcount}</playcount>\n')
+        # out.append(f'    <last_notes>{self.last_notes}</last_notes>\n')
+        if self.playtime.seconds == 0:
+            out.append(f'    <playtime>0</playtime>\n') # HTML側で処理しやすくしている
+            out.append(f'    <pace>0</pace>\n')
+        else:
+            out.append(f'    <playtime>{str(self.playtime).split(".")[0]}</playtime>\n')
+            out.append(f'    <pace>{int(3600*self.notes/self.playtime.seconds)}</pace>\n')
+        return ''.join(out)
 
-    def write_updates_xml(self, outfile='updates.xml'):
-        with open(outfile, 'w', encoding='utf-8') as f:
-            f.write(f'<?xml version="1.0" encoding="utf-8"?>\n')
-            f.write("<Items>\n")
-            f.write(f"    <date>{self.start_time.year}/{self.start_time.month:02d}/{self.start_time.day:02d}</date>\n")
-            f.write(f'    <notes>{self.notes}</notes>\n')
-            f.write(f'    <notes_month>{self.notes_month}</notes_month>\n')
-            f.write(f'    <total_score_rate>{self.score_rate:.2f}</total_score_rate>\n')
-            f.write(f'    <playcount>{self.playcount}</playcount>\n')
-            # f.write(f'    <last_notes>{self.last_notes}</last_notes>\n')
-            if self.playtime.seconds == 0:
-                f.write(f'    <playtime>0</playtime>\n') # HTML側で処理しやすくしている
-                f.write(f'    <pace>0</pace>\n')
-            else:
-                f.write(f'    <playtime>{str(self.playtime).split(".")[0]}</playtime>\n')
-                f.write(f'    <pace>{int(3600*self.notes/self.playtime.seconds)}</pace>\n')
+    def render_result(self, r:OneResult) -> str:
+        """1リザルト分の<Result>要素を返す"""
+        out = []
+        out.append(f'    <Result>\n')
+        # out.append(f'        <lv>{r.difficulties[0]}</lv>\n')
+        out.append(f'        <lv>{",".join(r.difficulties)}</lv>\n')
+        out.append(f'        <title>{self.escape_title(r.title)}</title>\n')
+        out.append(f'        <lamp>{r.lamp}</lamp>\n')
+        out.append(f'        <pre_lamp>{r.pre_lamp}</pre_lamp>\n')
+        out.append(f'        <score>{r.score}</score>\n')
+        out.append(f'        <pre_score>{r.pre_score}</pre_score>\n')
+        out.append(f'        <bp>{r.bp}</bp>\n')
+        out.append(f'        <pre_bp>{r.pre_bp}</pre_bp>\n')
+        if r.pre_score > 0:
+            out.append(f'        <diff_score>{r.score-r.pre_score:+}</diff_score>\n')
+        else: # 初プレイ時は空白
+            out.append(f'        <diff_score></diff_score>\n')
+        if r.pre_bp < 100000:
+            out.append(f'        <diff_bp>{r.bp-r.pre_bp:+}</diff_bp>\n')
+        else: # 初プレイ時は空白
+            out.append(f'        <diff_bp></diff_bp>\n')
+        out.append(f'        <score_rate>{float(r.score_rate):.2f}</score_rate>\n')
+        out.append(f'        <timestamp>{datetime.datetime.fromtimestamp(r.date)}</timestamp>\n')
+        out.append('    </Result>\n')
+        return ''.join(out)
 
-            for k in self.today_updates.keys():
-                r = self.today_updates[k]
+    def render_xml(self, header:str, results, fragments:dict=None, key_func=None) -> str:
+        """ヘッダとリザルトの配列からXML全体を組み立てる。
+        fragmentsを指定した場合、key_func(r)をキーとして<Result>要素をキャッシュし、2回目以降は再利用する。
+
+        Args:
+            header (str): render_header()の結果
+            results (iterable): OneResultの配列
+            fragments (dict, optional): <Result>要素のキャッシュ。 Defaults to None.
+            key_func (function, optional): リザルトからキャッシュのキーを求める関数。 Defaults to None.
+
+        Returns:
+            str: XML全体
+        """
+        out = [header]
+        for r in results:
+            if fragments is None:
+                fragment = None
+            else:
+                key = key_func(r)
+                fragment = fragments.get(key)
+            if fragment is None:
                 if not r.is_valid():
                     logger.debug(f"invalid data! skipped")
-                    continue
-                title_esc = r.title.replace('&', '&amp;').replace('<','&lt;').replace('>','&gt;').replace('"','&quot;').replace("'",'&apos;')
-                f.write(f'    <Result>\n')
-                # f.write(f'        <lv>{r.difficulties[0]}</lv>\n')
-                f.write(f'        <lv>{",".join(r.difficulties)}</lv>\n')
-                f.write(f'        <title>{title_esc}</title>\n')
-                f.write(f'        <lamp>{r.lamp}</lamp>\n')
-                f.write(f'        <pre_lamp>{r.pre_lamp}</pre_lamp>\n')
-                f.write(f'        <score>{r.score}</score>\n')
-                f.write(f'        <pre_score>{r.pre_score}</pre_score>\n')
-                f.write(f'        <bp>{r.bp}</bp>\n')
-                f.write(f'        <pre_bp>{r.pre_bp}</pre_bp>\n')
-                if r.pre_score > 0:
-                    f.write(f'        <diff_score>{r.score-r.pre_score:+}</diff_score>\n')
-                else: # 初プレイ時は空白
-                    f.write(f'        <diff_score></diff_score>\n')
-                if r.pre_bp < 100000:
-                    f.write(f'        <diff_bp>{r.bp-r.pre_bp:+}</diff_bp>\n')
-                else: # 初プレイ時は空白
-                    f.write(f'        <diff_bp></diff_bp>\n')
-                f.write(f'        <score_rate>{float(r.score_rate):.2f}</score_rate>\n')
-                f.write(f'        <timestamp>{datetime.datetime.fromtimestamp(r.date)}</timestamp>\n')
-                f.write('    </Result>\n')
-            f.write("</Items>\n")
+                    fragment = ''
+                else:
+                    fragment = self.render_result(r)
+                if fragments is not None:
+                    fragments[key] = fragment
+            out.append(fragment)
+        out.append("</Items>\n")
+        return ''.join(out)
+
+    def render_history(self, header:str) -> str:
+        """history.xmlの内容を返す"""
+        return self.render_xml(header, self.today_results, self.history_fragments, OneResult.get_key)
+
+    def render_updates(self, header:str) -> str:
+        """updates.xmlの内容を返す"""
+        return self.render_xml(header, self.today_updates.values(), self.updates_fragments, lambda r: r.sha256)
+
+    def write_output(self, outfile:str, content:str) -> bool:
+        """一時ファイルに書いてからos.replaceで差し替える。OBS側が書きかけのファイルを読まないようにするため。
+        前回書き出した内容と同じ場合は何もしない。
+
+        Args:
+            outfile (str): 出力先
+            content (str): 書き込む内容
+
+        Returns:
+            bool: 書き込んだ場合True
+        """
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        if (self.output_hash.get(outfile) == digest) and os.path.exists(outfile):
+            return False
+        tmpfile = outfile + '.tmp'
+        with open(tmpfile, 'w', encoding='utf-8') as f:
+            f.write(content)
+        for i in range(5):
+            try:
+                os.replace(tmpfile, outfile)
+                break
+            except PermissionError: # Windowsでは読み込み中のファイルを置き換えられないことがあるので少し待つ
+                if i == 4:
+                    logger.error(traceback.format_exc())
+                    return False
+                time.sleep(0.05)
+        self.output_hash[outfile] = digest
+        return True
+
+    def write_xml(self, history_file:str='history.xml', updates_file:str='updates.xml'):
+        """history.xmlとupdates.xmlをまとめて書き出す。ヘッダの生成は1回だけ行う。
+
+        Args:
+            history_file (str, optional): 本日の全リザルトの出力先。 Defaults to 'history.xml'.
+            updates_file (str, optional): 本日のリザルトを曲ごとにまとめたものの出力先。 Defaults to 'updates.xml'.
+        """
+        with self.output_lock:
+            header = self.render_header()
+            written = self.write_output(history_file, self.render_history(header))
+            written = self.write_output(updates_file, self.render_updates(header)) or written
+        if written and self.listeners: # 書き込み後に通知し、受け取った側がXMLを読み直せるようにする
+            self.notify('update', dict(self.get_stats(), seq=self.seq))
+
+    def write_history_xml(self, outfile='history.xml'):
+        with self.output_lock:
+            self.write_output(outfile, self.render_history(self.render_header()))
+
+    def write_updates_xml(self, outfile='updates.xml'):
+        with self.output_lock:
+            self.write_output(outfile, self.render_updates(self.render_header()))
 
     def tweet_summary(self):
         """本日の統計情報をツイートする
@@ -556,15 +1115,9 @@ class ManageResults:
     def tweet_history(self):
         """月、年の統計情報をツイートする
         """
-        logger.info(f"len(all_results):{len(self.all_results)}")
-        stats_month = defaultdict(int)
-        stats_year  = defaultdict(int)
-        for i,r in enumerate(self.all_results):
-            ts = datetime.datetime.fromtimestamp(r.date)
-            key = f"{ts.year}/{ts.month:02d}"
-            for i in range(4):
-                stats_month[key] += r.judge[i]
-                stats_year[str(ts.year)] += r.judge[i]
+        logger.info(f"len(all_results):{len(self.all_results)}, days:{len(self.daily_stats.days)}")
+        stats_month = {k:sum(v[:4]) for k,v in self.daily_stats.summarize(7).items()}
+        stats_year  = {k:sum(v[:4]) for k,v in self.daily_stats.summarize(4).items()}
         total_notes = sum(list(stats_month.values()))
 
         msg = f"total notes: {total_notes:,}\n"
@@ -579,11 +1132,280 @@ class ManageResults:
         encoded_msg = urllib.parse.quote(msg)
         webbrowser.open(f"https://twitter.com/intent/tweet?text={encoded_msg}")
 
+class DBConnectionPool:
+    """読み込み専用のsqlite3コネクションをdbfileごとに使い回すクラス。
+    読み出しは1つのトランザクション内で行い、ロック中の場合は待ち時間を延ばしながら読み出し全体をやり直す。
+    """
+    def __init__(self, max_retry:int=5, retry_wait:float=0.05, immutable_wait:float=10.0):
+        """
+        Args:
+            max_retry (int, optional): ロック時のリトライ回数。 Defaults to 5.
+            retry_wait (float, optional): 最初のリトライまでの待ち時間。リトライ毎に倍にする。 Defaults to 0.05.
+            immutable_wait (float, optional): 最終更新からこの秒数が経っていればimmutableで開く。 Defaults to 10.0.
+        """
+        self.max_retry = max_retry
+        self.retry_wait = retry_wait
+        self.immutable_wait = immutable_wait
+        self.conns = {} # (dbpath, attach) -> (コネクション, immutableで開いた時の(mtime, size))
+        self.stats = {'hit':0, 'miss':0, 'locked':0}
+        self.lock = threading.Lock()
+
+    def get_uri(self, dbpath:str, immutable:bool=False) -> str:
+        uri = 'file:' + urllib.request.pathname2url(os.path.abspath(dbpath)) + '?mode=ro'
+        if immutable:
+            uri += '&immutable=1'
+        return uri
+
+    def can_use_immutable(self, dbpath:str) -> bool:
+        """しばらく書き込まれていないdbfileのみimmutableで開く。書き込み中のものをimmutableで開くと壊れた状態を読む可能性がある。"""
+        if os.path.exists(dbpath+'-wal') or os.path.exists(dbpath+'-journal'):
+            return False
+        return time.time() - os.path.getmtime(dbpath) > self.immutable_wait
+
+    def connect(self, dbpath:str, attach:dict=None, immutable:bool=False) -> sqlite3.Connection:
+        """コネクションを取得する。開いたことがあれば使い回す。
+
+        Args:
+            dbpath (str): dbfileのパス
+            attach (dict, optional): 同じコネクションにATTACHするdbfile。別名 -> パス。 Defaults to None.
+            immutable (bool, optional): 書き込まれないdbfileであればimmutableで開く。 Defaults to False.
+
+        Returns:
+            sqlite3.Connection: コネクション
+        """
+        key = (dbpath, tuple(sorted((attach or {}).items())))
+        conn, sig = self.conns.get(key, (None, None))
+        if (conn is not None) and (sig is not None):
+            st = os.stat(dbpath)
+            if sig != (st.st_mtime, st.st_size): # immutableで開いた後に更新された
+                conn.close()
+                conn = None
+        if conn is not None:
+            self.stats['hit'] += 1
+            return conn
+
+        self.stats['miss'] += 1
+        sig = None
+        if immutable and self.can_use_immutable(dbpath):
+            st = os.stat(dbpath)
+            sig = (st.st_mtime, st.st_size)
+        conn = sqlite3.connect(self.get_uri(dbpath, sig is not None), uri=True, timeout=0.5, isolation_level=None, check_same_thread=False)
+        for alias, path in (attach or {}).items():
+            conn.execute(f'ATTACH DATABASE ? AS {alias}', (self.get_uri(path),))
+        self.conns[key] = (conn, sig)
+        return conn
+
+    def read(self, func, dbpath:str, attach:dict=None, immutable:bool=False):
+        """1つのトランザクション内でfunc(conn)を実行する。
+        トランザクション中はbeatorajaの書き込みを待たせる可能性があるため、funcはSQLの読み出しだけを行い、
+        DataFrameの加工などはreadの外で行うこと。ロックでリトライする場合はfuncを最初から実行し直すので、funcは副作用を持たないこと。
+        なお、ATTACHしたdbfileのスナップショットはそれぞれ最初に読んだ時点のものになり、dbfile間で同じ時点とは限らない。
+
+        Args:
+            func (function): コネクションを受け取って読み出しを行う関数
+            dbpath (str): dbfileのパス
+            attach (dict, optional): 同じコネクションにATTACHするdbfile。別名 -> パス。 Defaults to None.
+            immutable (bool, optional): 書き込まれないdbfileであればimmutableで開く。 Defaults to False.
+
+        Returns:
+            funcの返り値
+        """
+        with self.lock:
+            for i in range(self.max_retry+1):
+                conn = self.connect(dbpath, attach, immutable)
+                try:
+                    conn.execute('BEGIN')
+                    ret = func(conn)
+                    conn.execute('COMMIT')
+                    return ret
+                except sqlite3.OperationalError as e:
+                    self.rollback(conn)
+                    if ('locked' not in str(e)) and ('busy' not in str(e)):
+                        raise
+                    self.stats['locked'] += 1
+                    logger.warning(f"database is locked. retry:{i}, dbpath:{dbpath}, stats:{self.stats}")
+                    if i == self.max_retry:
+                        raise
+                    time.sleep(self.retry_wait * 2**i)
+                except Exception:
+                    self.rollback(conn)
+                    raise
+
+    def rollback(self, conn:sqlite3.Connection):
+        """トランザクション中であればROLLBACKする。ROLLBACKの失敗で元の例外が隠れないようにログだけ残す。"""
+        try:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+
+    def close(self):
+        """全てのコネクションを閉じる"""
+        with self.lock:
+            for conn, sig in self.conns.values():
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.conns = {}
+
+class SongInfoResolver:
+    """songdata.dbからsha256をキーに曲情報(md5, title, length)を引くクラス。
+    song tableを全件メモリに持たず、引いた結果だけをLRUキャッシュに保持する。
+    見つからなかった曲はキャッシュしないので、songdata.dbに追加された曲も次回から引ける。
+    song tableはpathが主キーでsha256にindexが無いため、sha256 -> rowidの対応だけを持っておき、rowidで引く。
+    """
+    COLUMNS = ['sha256', 'md5', 'title', 'length']
+
+    def __init__(self, db_pool:DBConnectionPool, cache_size:int=4096, batch_size:int=500):
+        """
+        Args:
+            db_pool (DBConnectionPool): 読み出しに使うコネクション管理クラス
+            cache_size (int, optional): キャッシュする曲数。 Defaults to 4096.
+            batch_size (int, optional): 1回のクエリに含めるrowidの数。 Defaults to 500.
+        """
+        self.db_pool = db_pool
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.dbpath = None
+        self.db_signature = None # songdata.dbの(mtime, size)。変化したらキャッシュを捨てる
+        self.cache = OrderedDict() # sha256 -> (md5, title, length)
+        self.rowids = None # sha256(32byte) -> song tableのrowid。songdata.dbが更新されたら作り直す
+
+    def set_dbpath(self, dbpath:str):
+        """songdata.dbのパスを設定する
+
+        Args:
+            dbpath (str): songdata.dbのパス
+        """
+        if dbpath != self.dbpath:
+            self.dbpath = dbpath
+            self.cache.clear()
+            self.rowids = None
+            self.db_signature = None
+
+    def check_update(self):
+        """songdata.dbが更新されていればキャッシュを捨てる"""
+        st = os.stat(self.dbpath)
+        signature = (st.st_mtime, st.st_size)
+        if signature != self.db_signature:
+            self.cache.clear()
+            self.rowids = None
+            self.db_signature = signature
+
+    @staticmethod
+    def to_key(hsh) -> bytes:
+        """rowidの対応表のキー(sha256の16進文字列を32byteにしたもの)を返す。sha256として不正な場合はNone。"""
+        try:
+            return bytes.fromhex(hsh)
+        except (TypeError, ValueError):
+            return None
+
+    def build_rowids(self, conn:sqlite3.Connection) -> dict:
+        """sha256 -> rowidの対応表を作る。同じsha256が複数ある場合は最後の行を使う。
+
+        Args:
+            conn (sqlite3.Connection): songdata.dbのコネクション
+
+        Returns:
+            dict: sha256(32byte) -> rowid
+        """
+        ret = {}
+        for rowid, sha256 in conn.execute('SELECT rowid, sha256 FROM song ORDER BY rowid'):
+            key = self.to_key(sha256)
+            if key is not None:
+                ret[key] = rowid
+        logger.debug(f"song rowids built. ({len(ret)} songs)")
+        return ret
+
+    def query(self, conn:sqlite3.Connection, hashes:list) -> dict:
+        """指定したsha256の曲情報をrowidで読み出す。同じsha256が複数ある場合は最後の行を使う。
+
+        Args:
+            conn (sqlite3.Connection): songdata.dbのコネクション
+            hashes (list): sha256の配列
+
+        Returns:
+            dict: sha256 -> (md5, title, length)
+        """
+        if self.rowids is None:
+            self.rowids = self.build_rowids(conn)
+        rowids = [self.rowids.get(self.to_key(h)) for h in hashes]
+        rowids = [r for r in rowids if r is not None]
+        ret = {}
+        for i in range(0, len(rowids), self.batch_size):
+            batch = rowids[i:i+self.batch_size]
+            placeholder = ','.join(['?']*len(batch))
+            for sha256, md5, title, length in conn.execute(f'SELECT {",".join(self.COLUMNS)} FROM song WHERE rowid IN ({placeholder})', batch):
+                ret[sha256] = (md5, title, length)
+        return ret
+
+    def get(self, hsh:str) -> tuple:
+        """1曲分の曲情報を返す
+
+        Args:
+            hsh (str): sha256
+
+        Returns:
+            tuple: (md5, title, length)。見つからない場合はNone。
+        """
+        self.check_update()
+        if hsh in self.cache.keys():
+            self.cache.move_to_end(hsh)
+            return self.cache[hsh]
+        ret = self.db_pool.read(lambda conn: self.query(conn, [hsh]), self.dbpath, immutable=True).get(hsh)
+        if ret is not None:
+            self.cache[hsh] = ret
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ret
+
+    def prefetch(self, hashes:list) -> dict:
+        """複数曲の曲情報をまとめて返す。過去ログの一括読み込み用で、結果はキャッシュしない。
+
+        Args:
+            hashes (list): sha256の配列
+
+        Returns:
+            dict: sha256 -> (md5, title, length)。見つからないものは含まれない。
+        """
+        self.check_update()
+        hashes = list(set(hashes))
+        return self.db_pool.read(lambda conn: self.query(conn, hashes), self.dbpath, immutable=True)
+
 class DataBaseAccessor:
-    def __init__(self):
+    # 各tableから読み込む列とその型。ここに無い列は読み込まない(rowidは常に_rowidとして読む)
+    # sha256はプレー毎に同じ値が並ぶscorelog/scoredatalogのみcategoryにする
+    JUDGE_COLUMNS = ['epg', 'lpg', 'egr', 'lgr', 'egd', 'lgd', 'ebd', 'lbd', 'epr', 'lpr', 'ems', 'lms']
+    DB_COLUMNS = {
+        'information':  {'sha256':'object'},
+        'score':        {'sha256':'object', 'clear':'int8', 'notes':'int32', 'playcount':'int32', 'date':'int64', **{c:'int32' for c in JUDGE_COLUMNS}},
+        'scorelog':     {'sha256':'category', 'clear':'int8', 'oldclear':'int8', 'score':'int32', 'oldscore':'int32', 'minbp':'int64', 'oldminbp':'int64', 'date':'int64'},
+        'scoredatalog': {'sha256':'category', 'clear':'int8', 'notes':'int32', 'playcount':'int32', 'date':'int64', **{c:'int32' for c in JUDGE_COLUMNS}},
+    }
+
+    def __init__(self, manage_results:ManageResults=None):
+        """
+        Args:
+            manage_results (ManageResults, optional): 他のDataBaseAccessorと共有するManageResults。
+                playlogのjournalやsnapshotを書くインスタンスが1つになるよう、設定画面などからはメインのものを渡す。
+                渡した場合、その設定(set_config)は持ち主が行う。 Defaults to None.
+        """
         self.difftable = DiffTable() # 難易度情報を取得するために持っておく
-        self.manage_results = ManageResults() # xml出力向けにOneResultの配列を持っておく
+        self.owns_results = manage_results is None
+        self.manage_results = ManageResults() if manage_results is None else manage_results # xml出力向けにOneResultの配列を持っておく
         self.db_updated_date = {} # 各dbfileの最終更新日時を覚えておく、必要なものだけ読み込む
+        self.db_cursor = {} # table名 -> 最後に読み込んだrowidとスキーマ。差分読み込みに使う
+        self.db_frames = {} # table名 -> 読み込み済みのDataFrame。差分をここに追記していく
+        self.db_index = {} # table名 -> {sha256: 行番号}。同じhashが複数ある場合は最後の行を指す
+        self.db_pool = DBConnectionPool()
+        self.song_resolver = SongInfoResolver(self.db_pool) # 曲名などはsongdata.dbから必要な分だけ引く
+        self.ingest_cursor = None # 処理済みのscoredatalogの位置。{'path':dbpath, 'rowid':rowid, 'deferred':{rowid:試行回数}}
+        self.max_defer = 5 # score.dbやsongdata.dbにまだ無いプレーを取り込み直す回数
+        self.df_score = None
+        self.df_scorelog = None
+        self.df_scoredatalog = None
+        self.df_songinfo = None
 
     def is_valid(self):
         """すべての設定ファイルが存在すればTrue,無効な設定があればFalseを返す
@@ -599,6 +1421,14 @@ class DataBaseAccessor:
         ret &= os.path.exists(self.db_songinfo)
         return ret
 
+    def get_watch_files(self) -> list:
+        """リザルト登録時に更新されるdbfileの一覧を返す。DBFileWatcherの監視対象。
+
+        Returns:
+            list: dbfileのパスの配列
+        """
+        return [self.db_score, self.db_scorelog, self.db_scoredatalog]
+
     def set_config(self, config:Config):
         """設定ファイルを読み込み、各dbfileのパスを更新する。
 
@@ -608,93 +1438,247 @@ class DataBaseAccessor:
         logger.info('config updated')
         self.config = config
         self.difftable.set_config(config)
-        self.manage_results.set_config(config)
+        if self.owns_results:
+            self.manage_results.set_config(config)
         self.db_songdata     = os.path.join(self.config.oraja_path, 'songdata.db')
         self.db_songinfo     = os.path.join(self.config.oraja_path, 'songinfo.db')
         self.db_score        = os.path.join(self.config.player_path, 'score.db')
         self.db_scorelog     = os.path.join(self.config.player_path, 'scorelog.db')
         self.db_scoredatalog = os.path.join(self.config.player_path, 'scoredatalog.db')
+        self.db_pool.close() # パスが変わっている可能性があるので開き直す
+        self.song_resolver.set_dbpath(self.db_songdata)
 
         # configが確定した時点でdbをリロード
         reload = self.reload_db()
         print(f"reloaded: {reload}")
-        self.manage_results.set_config(config)
+        if (self.ingest_cursor is None) or (self.ingest_cursor['path'] != self.db_scoredatalog):
+            self.reset_ingest_cursor() # 起動前のリザルトはread_old_results()で扱う。設定の保存だけの場合は未処理の行を残す
+        if self.owns_results:
+            self.manage_results.set_config(config)
 
-    def load_one_dbfile(self, dbpath:str, dbname:str) -> pd.DataFrame:
+    def get_db_mtime(self, dbpath:str) -> float:
+        """dbfileの最終更新時刻を返す。WALモードの場合はcheckpointまで本体が更新されないので-walも見る。"""
+        current = os.path.getmtime(dbpath)
+        if os.path.exists(dbpath+'-wal'):
+            current = max(current, os.path.getmtime(dbpath+'-wal'))
+        return current
+
+    def load_one_dbfile(self, dbpath:str, dbname:str, immutable:bool=False) -> pd.DataFrame:
         """1つのdbfileをロードする。最終更新時刻を用いて、更新のないものはスキップする。
+        2回目以降は前回読み込んだrowidより新しい行だけを読み出して追記する。
+        テーブルが縮んだ場合やスキーマが変わった場合は全件読み直す。
         返り値は代入時に受け側でケアする必要がある。
 
         Args:
             dbpath (str): dbfileのパス
             dbname (str): dbfile内で対象とするtable名
+            immutable (bool, optional): beatorajaがプレー中に書き込まないdbfileの場合True。 Defaults to False.
 
         Returns:
-            pd.DataFrame: 読み出した結果
+            pd.DataFrame: 読み出した結果。新しい行が無かった場合はNone。
         """
-        current = os.path.getmtime(dbpath)
-        last_updated_time = self.db_updated_date.get(dbname) or 0.0
-        if current > last_updated_time:
-            conn = sqlite3.connect(dbpath)
-            self.db_updated_date[dbname] = current
-            print(f"dbfile reloaded. (dbpath:{dbpath}, dbname:{dbname})")
-            return pd.read_sql(f'SELECT * FROM {dbname}', conn)
+        current = self.get_db_mtime(dbpath)
+        if current > (self.db_updated_date.get(dbname) or 0.0):
+            fetched = self.db_pool.read(lambda c: self.fetch_table_diff(c, dbpath, dbname), dbpath, immutable=immutable)
+            ret = self.apply_table_diff(dbpath, dbname, fetched)
+            self.db_updated_date[dbname] = current # 読み込みに失敗した場合は次回読み直す
+            return ret
         # else:
         #     print(f'dbfile is not updated! skipped.')
 
+    def fetch_table_diff(self, conn:sqlite3.Connection, dbpath:str, dbname:str, schema:str='main') -> dict:
+        """rowidをカーソルとして、前回以降に追加された行を読み出す。DBConnectionPool.read()の中で呼ぶため、
+        SQLの実行結果をそのまま返すだけにし、self.db_framesなどの状態は変更しない(加工はapply_table_diff()で行う)。
+
+        Args:
+            conn (sqlite3.Connection): 読み出しに使うコネクション
+            dbpath (str): dbfileのパス
+            dbname (str): dbfile内で対象とするtable名
+            schema (str, optional): connにATTACHしたdbfileを読む場合の別名。 Defaults to 'main'.
+
+        Returns:
+            dict: {'schema':列名, 'max_rowid', 'full':全件読んだ場合True, 'names':読んだ列名, 'rows':読んだ行, 'alive':残っている行のrowid(行が消えた場合のみ)}
+        """
+        columns = [r[1] for r in conn.execute(f'PRAGMA {schema}.table_info({dbname})')]
+        max_rowid, count = conn.execute(f'SELECT MAX(rowid), COUNT(*) FROM {schema}.{dbname}').fetchone()
+        max_rowid = max_rowid or 0
+        projection = ', '.join(['rowid AS _rowid'] + self.get_columns(dbname, columns))
+        cursor = self.db_cursor.get(dbname)
+        df = self.db_frames.get(dbname)
+        full = (cursor is None) or (df is None) or (cursor['path'] != dbpath) or (cursor['schema'] != columns) or (max_rowid < cursor['rowid'])
+        if full:
+            res = conn.execute(f'SELECT {projection} FROM {schema}.{dbname}')
+        else:
+            res = conn.execute(f'SELECT {projection} FROM {schema}.{dbname} WHERE rowid > ?', (cursor['rowid'],))
+        rows = res.fetchall()
+        names = [d[0] for d in res.description]
+        alive = None
+        if (not full) and (len(df)+len(rows) != count):
+            # INSERT OR REPLACEやDELETEで消えた行がある
+            alive = [r[0] for r in conn.execute(f'SELECT rowid FROM {schema}.{dbname}')]
+        return {'schema':columns, 'max_rowid':max_rowid, 'full':full, 'names':names, 'rows':rows, 'alive':alive}
+
+    def apply_table_diff(self, dbpath:str, dbname:str, fetched:dict) -> pd.DataFrame:
+        """fetch_table_diff()で読み出した行をself.db_framesに追記し、indexとカーソルを更新する。
+
+        Args:
+            dbpath (str): dbfileのパス
+            dbname (str): dbfile内で対象とするtable名
+            fetched (dict): fetch_table_diff()の返り値
+
+        Returns:
+            pd.DataFrame: 追記後の全体。更新が無かった場合はNone。
+        """
+        diff = self.set_dtypes(dbname, pd.DataFrame.from_records(fetched['rows'], columns=fetched['names'], coerce_float=True))
+        if fetched['full']:
+            df = diff
+            self.build_index(dbname, df)
+            print(f"dbfile reloaded. (dbpath:{dbpath}, dbname:{dbname}, rows:{len(df)})")
+        else:
+            df = self.db_frames[dbname]
+            offset = len(df)
+            if len(diff) > 0:
+                # categoryの値が増えるとobjectになるので型を付け直す
+                df = self.set_dtypes(dbname, pd.concat([df, diff], ignore_index=True))
+            if fetched['alive'] is not None:
+                # 消えた行を落とす。行番号がずれるのでindexも作り直す
+                df = df[df['_rowid'].isin(fetched['alive'])].reset_index(drop=True)
+                self.build_index(dbname, df)
+            elif len(diff) == 0:
+                return None
+            else:
+                self.build_index(dbname, diff, offset)
+            print(f"dbfile updated. (dbpath:{dbpath}, dbname:{dbname}, new rows:{len(diff)})")
+
+        self.db_cursor[dbname] = {'path':dbpath, 'schema':fetched['schema'], 'rowid':fetched['max_rowid']}
+        self.db_frames[dbname] = df
+        return df
+
+    def get_columns(self, dbname:str, columns:list) -> list:
+        """DB_COLUMNSで指定された列のうち、実際にtableに存在するものを返す。
+
+        Args:
+            dbname (str): dbfile内で対象とするtable名
+            columns (list): tableに存在する列名
+
+        Returns:
+            list: 読み込む列名。DB_COLUMNSに登録されていないtableの場合は全列。
+        """
+        if dbname not in self.DB_COLUMNS.keys():
+            return ['*']
+        return [c for c in self.DB_COLUMNS[dbname].keys() if c in columns]
+
+    def set_dtypes(self, dbname:str, df:pd.DataFrame) -> pd.DataFrame:
+        """DB_COLUMNSで指定された型に変換する。NULLを含むなどで変換できない列はそのままにする。
+
+        Args:
+            dbname (str): dbfile内で対象とするtable名
+            df (pd.DataFrame): 変換対象
+
+        Returns:
+            pd.DataFrame: 変換結果
+        """
+        for c, dtype in self.DB_COLUMNS.get(dbname, {}).items():
+            if (c in df.columns) and (df[c].dtype != dtype):
+                try:
+                    df[c] = df[c].astype(dtype)
+                except (ValueError, TypeError):
+                    pass
+        return df
+
+    def build_index(self, dbname:str, df:pd.DataFrame, offset:int=0):
+        """sha256から行番号を引くためのdictを作成する。offset>0の場合は既存のdictに追記する。
+
+        Args:
+            dbname (str): dbfile内で対象とするtable名
+            df (pd.DataFrame): 登録する行
+            offset (int, optional): dfの先頭行の行番号。 Defaults to 0.
+        """
+        if 'sha256' not in df.columns:
+            return
+        index = self.db_index.get(dbname, {}) if offset > 0 else {}
+        # 後ろの行で上書きされるので、同じhashは最新の行を指す(tail(1)と同じ)
+        index.update(zip(df['sha256'], range(offset, offset+len(df))))
+        self.db_index[dbname] = index
+
+    def lookup(self, dbname:str, hsh:str) -> pd.DataFrame:
+        """指定したtableからsha256が一致する最新の1行を返す。
+
+        Args:
+            dbname (str): dbfile内で対象とするtable名
+            hsh (str): sha256
+
+        Returns:
+            pd.DataFrame: 1行(見つからない場合は0行)のDataFrame
+        """
+        df = self.db_frames[dbname]
+        pos = self.db_index.get(dbname, {}).get(hsh)
+        if pos is None:
+            return df.iloc[0:0]
+        return df.iloc[pos:pos+1]
+
         """dbを一通りリロード
         """
     def reload_db(self) -> bool:
         """dbfileを一通りリロードする
 
         Returns:
-            bool: score.dbに更新があった場合True
+            bool: 取り込むリザルトがありうる場合(scoredatalogが更新された場合、保留中のプレーがありscore.dbが更新された場合)True
         """
         if not self.is_valid():
             print('dbfiles invalid! skipped')
             return False
-        tmp_df_scorelog = self.load_one_dbfile(self.db_scorelog, 'scorelog')
+        # score/scorelog/scoredatalogは1つのトランザクションで読み出し、加工はトランザクションの外で行う
+        targets = [(dbpath, dbname, self.get_db_mtime(dbpath)) for dbpath, dbname in ((self.db_scorelog, 'scorelog'), (self.db_score, 'score'), (self.db_scoredatalog, 'scoredatalog'))]
+        targets = [t for t in targets if t[2] > (self.db_updated_date.get(t[1]) or 0.0)]
+        def read_scores(conn):
+            return {dbname:self.fetch_table_diff(conn, dbpath, dbname, 'main' if dbname == 'score' else dbname) for dbpath, dbname, current in targets}
+        fetched = self.db_pool.read(read_scores, self.db_score, attach={'scorelog':self.db_scorelog, 'scoredatalog':self.db_scoredatalog}) if targets else {}
+        results = {'scorelog':None, 'score':None, 'scoredatalog':None}
+        for dbpath, dbname, current in targets:
+            results[dbname] = self.apply_table_diff(dbpath, dbname, fetched[dbname])
+            self.db_updated_date[dbname] = current
+        tmp_df_scorelog = results['scorelog']
         self.df_scorelog = tmp_df_scorelog if tmp_df_scorelog is not None else self.df_scorelog
-        tmp_df_score = self.load_one_dbfile(self.db_score, 'score')
+        tmp_df_score = results['score']
         self.df_score = tmp_df_score if tmp_df_score is not None else self.df_score
-        tmp_df_scoredatalog = self.load_one_dbfile(self.db_scoredatalog, 'scoredatalog')
+        tmp_df_scoredatalog = results['scoredatalog']
         self.df_scoredatalog = tmp_df_scoredatalog if tmp_df_scoredatalog is not None else self.df_scoredatalog
 
-        tmp_df_songdata = self.load_one_dbfile(self.db_songdata, 'song')
-        self.df_songdata = tmp_df_songdata if tmp_df_songdata is not None else self.df_songdata
-        tmp_df_songinfo = self.load_one_dbfile(self.db_songinfo, 'information')
+        tmp_df_songinfo = self.load_one_dbfile(self.db_songinfo, 'information', immutable=True)
         self.df_songinfo = tmp_df_songinfo if tmp_df_songinfo is not None else self.df_songinfo
 
-        #return (tmp_df_scorelog is not None) or (tmp_df_score is not None) or (tmp_df_scoredatalog is not None) or (tmp_df_songdata is not None) or (tmp_df_songinfo is not None)
-        return (tmp_df_score is not None) and (tmp_df_scoredatalog is not None)
+        #return (tmp_df_scorelog is not None) or (tmp_df_score is not None) or (tmp_df_scoredatalog is not None) or (tmp_df_songinfo is not None)
+        # score.dbへの書き込みが遅れて取り込みを保留したプレーがあれば、score.dbの更新だけでも読み直させる
+        has_deferred = (self.ingest_cursor is not None) and (len(self.ingest_cursor['deferred']) > 0)
+        return (tmp_df_scoredatalog is not None) or ((tmp_df_score is not None) and has_deferred)
 
     def parse(self, tmpdat) -> OneResult:
         """df_dataの1エントリを受けてOneResultに格納して返す。難易度の取得もここで行う。
+        曲情報はprefetch()、更新前の記録はget_pre_records()で求め、parse_all()と同じ結果になる。
 
         Args:
             tmpdat (DataFrame): 1プレイ分のデータ。判定はepg,lpgなどに入っている。
 
         Returns:
-            OneResult: parseの結果
+            OneResult: parseの結果。曲が見つからない場合はFalse。
         """
         if type(tmpdat['sha256']) == str:
             hsh = tmpdat['sha256']
         else:
             hsh=tmpdat['sha256'].iloc[0]
-        tmpsc = self.df_score[self.df_score['sha256'] == hsh].tail(1)
-        tmp = self.df_scorelog[self.df_scorelog['sha256'] == hsh].tail(1)
-        #pre_score = tmp.oldscore.iloc[0]
+        tmpsc = self.lookup('score', hsh)
+        if len(tmpsc) == 0:
+            logger.debug(f'score not found!!!, hsh={hsh}')
+            return False
         notes = tmpsc.notes.iloc[0]
         # logger.debug(f'hsh:{hsh}\n')
-        info = self.df_songdata[self.df_songdata['sha256'] == hsh].tail(1)
-        # logger.debug(f'type(info):{type(info)}, info.shape:{info.shape}')
-        if info.shape[0] > 0:
-            title = info.title.iloc[0]
-            length = info.length.iloc[0]
+        info = self.song_resolver.prefetch([hsh]).get(hsh)
+        if info is not None:
+            md5, title, length = info
         else:
+            logger.debug(f'song not found!!!, hsh={hsh}')
             return False
-            title = info.title
-            length = info.length
-            logger.debug(f'shape[0]==0!!!, title={title}')
         lampid = tmpdat.clear#.iloc[0]
         judge = [
             tmpdat.epg+tmpdat.lpg,
@@ -709,27 +1693,195 @@ class DataBaseAccessor:
         bp   += (notes-judge[0]-judge[1]-judge[2]-judge[3]-judge[4]) # 完走していない場合は引く
         score_rate = f"{score/notes*100/2:.2f}"
         ret = OneResult(title=title, lamp=lampid, score=score, score_rate=score_rate, judge=judge, bp=bp, length=length, sha256=hsh, date=tmpdat.date, notes=notes)
-        ret.difficulties = sorted(list(set(self.difftable.difftable[info.sha256.iloc[0]]+self.difftable.difftable[info.md5.iloc[0]])))
+        ret.difficulties = sorted(list(set(self.difftable.search_from_hash(hsh)+self.difftable.search_from_hash(md5))))
         if tmpdat['playcount'] > 1:
-            ret.pre_score = tmp.oldscore.max()
-            ret.pre_bp = tmp.oldminbp.min()
-            ret.pre_lamp = tmp.oldclear.max()
+            pre_score, pre_bp, pre_lamp = self.get_pre_records([hsh], [tmpdat.date])
+            ret.pre_score = pre_score[0]
+            ret.pre_bp = pre_bp[0]
+            ret.pre_lamp = pre_lamp[0]
+        return ret
+
+    def parse_all(self, df:pd.DataFrame) -> list:
+        """複数のプレーデータをまとめてOneResultに変換する。
+        score/scorelog/songとの突き合わせや判定の集計を列単位で行うため、parse()を1行ずつ呼ぶより高速。
+        結果はparse()を各行に適用した場合と同じ(score/songdataに無い曲は除外)。
+        更新前の記録(pre_*)はget_pre_records()でプレー時刻に対応するscorelogの行から求める。
+
+        Args:
+            df (DataFrame): df_scoreやdf_scoredatalogと同じ形式のプレーデータ
+
+        Returns:
+            list: OneResultの配列。dfの行順を保つ。
+        """
+        # songdataに無いものはparse()と同様に除外
+        df = df.astype({'sha256':object}) # categoryのままだとmapの結果もcategoryになる
+        infos = self.song_resolver.prefetch(df['sha256'].tolist())
+        df = df[df['sha256'].isin(infos.keys()).to_numpy()]
+        if len(df) == 0:
+            return []
+        # score.dbにまだ行が無いもの(scoredatalogとscoreの書き込みの間に読んだ場合など)は除外
+        pos_score = df['sha256'].map(self.db_index.get('score', {}))
+        if pos_score.isna().any():
+            logger.info(f"skipped {int(pos_score.isna().sum())} rows (not found in score)")
+            df = df[pos_score.notna().to_numpy()]
+            pos_score = pos_score[pos_score.notna()]
+            if len(df) == 0:
+                return []
+        pos_score = pos_score.astype(int).to_numpy()
+        hashes = df['sha256'].to_numpy()
+        md5s, titles, lengths = zip(*[infos[h] for h in hashes])
+        notes = self.db_frames['score']['notes'].to_numpy()[pos_score]
+
+        judge = np.column_stack([
+            (df.epg+df.lpg).to_numpy(),
+            (df.egr+df.lgr).to_numpy(),
+            (df.egd+df.lgd).to_numpy(),
+            (df.ebd+df.lbd).to_numpy(),
+            (df.epr+df.lpr).to_numpy(),
+            (df.ems+df.lms).to_numpy(),
+        ])
+        score = judge[:,0]*2+judge[:,1]
+        bp    = judge[:,3]+judge[:,4]+judge[:,5]
+        bp   += (notes-judge[:,:5].sum(axis=1)) # 完走していない場合は引く
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score_rate = score/notes*100/2
+        lamps = df['clear'].to_numpy()
+        dates = df['date'].to_numpy()
+        playcounts = df['playcount'].to_numpy()
+
+        pre_score, pre_bp, pre_lamp = self.get_pre_records(hashes, dates)
+
+        ret = []
+        for i in range(len(df)):
+            r = OneResult(title=titles[i], lamp=lamps[i], score=score[i], score_rate=f"{score_rate[i]:.2f}", judge=list(judge[i]), bp=bp[i], length=lengths[i], sha256=hashes[i], date=dates[i], notes=notes[i])
+            r.difficulties = sorted(list(set(self.difftable.search_from_hash(hashes[i])+self.difftable.search_from_hash(md5s[i]))))
+            if playcounts[i] > 1:
+                r.pre_score = pre_score[i]
+                r.pre_bp = pre_bp[i]
+                r.pre_lamp = pre_lamp[i]
+            ret.append(r)
         return ret
-        #return title, lampid, score, pre_score, score_rate, tmpdat.date, judge
 
-    def read_one_result(self):
-        """最新のリザルト1つを受け取って処理する。manage_results及びplaylogに登録する。
+    def get_pre_records(self, hashes, dates) -> tuple:
+        """各プレーの直前の自己ベスト(スコア, BP, ランプ)をscorelogから求める。
+        scorelogは記録を更新したプレーごとに1行ある。プレー時刻以降で最初の行があればその更新前の値(old*)、
+        無ければプレー時刻より前の最新の行の更新後の値が直前の自己ベストになる。
+        1回の取り込みで同じ譜面を複数回プレーしていても、プレーごとに正しい値になる。
+
+        Args:
+            hashes (np.ndarray): 各プレーのsha256
+            dates (np.ndarray): 各プレーの時刻
+
+        Returns:
+            tuple: (pre_score, pre_bp, pre_lamp)の配列。scorelogに無い場合はNaN。
         """
-        idx = len(self.df_scoredatalog) - 1
-        tmp_song = self.df_scoredatalog.iloc[idx, :]
-        tmp_result = self.parse(tmp_song)
-        logger.info(f'read_one_result, idx={idx}, title={tmp_result.title}, difficulties={tmp_result.difficulties}')
-        tmp_result.disp()
-        self.manage_results.add_result(tmp_result)
+        scorelog = self.db_frames.get('scorelog')
+        n = len(hashes)
+        if (scorelog is None) or (len(scorelog) == 0):
+            return np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
+        if not {'date', 'score', 'minbp', 'clear'}.issubset(scorelog.columns):
+            # 時刻が無いscorelogの場合は最新行の更新前の値を使う
+            pos_log = pd.Series(hashes).map(self.db_index.get('scorelog', {})).to_numpy()
+            found = pos_log == pos_log # NaNでない
+            ret = []
+            for c in ('oldscore', 'oldminbp', 'oldclear'):
+                v = np.full(n, np.nan, dtype=object)
+                v[found] = scorelog[c].to_numpy()[pos_log[found].astype(int)]
+                ret.append(v)
+            return tuple(ret)
+        # 対象の譜面の行だけを(譜面, 時刻)の順に並べ、各プレーの位置を二分探索で求める
+        hashes = np.asarray(hashes, dtype=object)
+        dates = np.asarray(dates, dtype=np.int64)
+        log = scorelog[scorelog['sha256'].isin(set(hashes)).to_numpy()]
+        codes = {h:i for i,h in enumerate(dict.fromkeys(log['sha256'].astype(object)))}
+        log_code = np.array([codes[h] for h in log['sha256'].astype(object)], dtype=np.int64)
+        log_date = log['date'].to_numpy(dtype=np.int64)
+        play_code = np.array([codes.get(h, -1) for h in hashes], dtype=np.int64)
+        base = min(log_date.min(initial=0), dates.min(initial=0))
+        span = max(log_date.max(initial=0), dates.max(initial=0)) - base + 1
+        log_key = log_code*span + (log_date-base)
+        order = np.argsort(log_key, kind='stable') # 同じ時刻の行はrowid順のまま
+        log_key = log_key[order]
+        k = np.searchsorted(log_key, play_code*span + (dates-base), side='left') # プレー時刻以降で最初の行
+        found_after = (play_code >= 0) & (k < len(order))
+        found_after[found_after] = log_code[order[k[found_after]]] == play_code[found_after]
+        found_before = (play_code >= 0) & (~found_after) & (k > 0)
+        found_before[found_before] = log_code[order[k[found_before]-1]] == play_code[found_before]
+        # 見つからなかったものだけNaNにし、それ以外は整数のまま返す
+        ret = []
+        for old_col, new_col in (('oldscore', 'score'), ('oldminbp', 'minbp'), ('oldclear', 'clear')):
+            v = np.full(n, np.nan, dtype=object)
+            v[found_before] = log[new_col].to_numpy()[order[k[found_before]-1]]
+            v[found_after] = log[old_col].to_numpy()[order[k[found_after]]]
+            ret.append(v)
+        return tuple(ret)
+
+    def reset_ingest_cursor(self):
+        """現在のscoredatalogの末尾までを処理済みとする。scoredatalogを読めていない場合は、読めた時点の末尾からにする。"""
+        if (self.df_scoredatalog is None) or ('_rowid' not in self.df_scoredatalog.columns):
+            self.ingest_cursor = None
+            return
+        rowid = int(self.df_scoredatalog['_rowid'].max()) if len(self.df_scoredatalog) > 0 else 0
+        self.ingest_cursor = {'path':self.db_scoredatalog, 'rowid':rowid, 'deferred':{}}
+
+    def has_unread_results(self) -> bool:
+        """読み込み済みのscoredatalogに、前回の取り込みが失敗して未処理のまま残っている行があればTrue"""
+        cursor = self.ingest_cursor
+        df = self.df_scoredatalog
+        if (cursor is None) or (df is None) or ('_rowid' not in df.columns) or (len(df) == 0):
+            return False
+        return (cursor['path'] == self.db_scoredatalog) and (int(df['_rowid'].max()) > cursor['rowid'])
+
+    def read_new_results(self) -> list:
+        """前回処理した位置より後のscoredatalogの行を全て古い順に処理する。manage_results及びplaylogに登録する。
+        ポーリングの間に複数のリザルトが書き込まれても取りこぼさないようにするため。
+        統計情報の更新や保存は呼び出し側でまとめて1回だけ行う。
+
+        Returns:
+            list: 追加したリザルト(OneResult)の配列
+        """
+        cursor = self.ingest_cursor
+        df = self.df_scoredatalog
+        if (cursor is None) or (cursor['path'] != self.db_scoredatalog) or (df is None) or ('_rowid' not in df.columns):
+            self.reset_ingest_cursor()
+            return []
+        if (len(df) > 0) and (df['_rowid'].max() < cursor['rowid']):
+            # scoredatalogが作り直された場合は過去分を取り込み直さない
+            logger.info(f"scoredatalog shrank, cursor reset. (rowid:{cursor['rowid']})")
+            self.reset_ingest_cursor()
+            return []
+        deferred = cursor['deferred']
+        new_rows = df[(df['_rowid'] > cursor['rowid']) | df['_rowid'].isin(list(deferred.keys()))].sort_values('_rowid')
+        if len(new_rows) == 0:
+            return []
+
+        # score.dbにまだ行が無いプレーや、songdata.dbにまだ曲が無いプレーは、次の読み込みまで保留する
+        hashes = new_rows['sha256'].astype(object)
+        infos = self.song_resolver.prefetch(hashes.tolist())
+        missing = (hashes.map(self.db_index.get('score', {})).isna() | ~hashes.isin(infos.keys())).to_numpy()
+        ret = self.parse_all(new_rows[~missing]) if (~missing).any() else []
+        for tmp_result in ret:
+            logger.info(f'read_new_results, title={tmp_result.title}, difficulties={tmp_result.difficulties}')
+            tmp_result.disp()
+            self.manage_results.add_result(tmp_result)
+
+        # 例外で中断した場合は位置を進めず、次回同じ行から読み直す(add_result()は重複を登録しない)
+        cursor['rowid'] = max(cursor['rowid'], int(new_rows['_rowid'].max()))
+        for rowid in new_rows['_rowid'][~missing].astype(int):
+            deferred.pop(rowid, None)
+        for rowid in new_rows['_rowid'][missing].astype(int):
+            deferred[rowid] = deferred.get(rowid, 0) + 1
+            if deferred[rowid] > self.max_defer:
+                logger.warning(f'gave up row (not found in score or songdata). rowid:{rowid}')
+                deferred.pop(rowid)
+        return ret
 
     def read_old_results(self):
         """oraja_helper起動前のリザルトをself.manage_resultsに追加する。
         manage_results.all_resultsへの登録及び、オフセット条件を満たすもののmanage_results.today_resultsへの登録も行う。
+        1件ごとの'result'の通知は行わない。overlayへは呼び出し側のwrite_xml()による'update'で1回だけ通知される。
+        pre_*はscore.dbの最終プレー時刻時点の自己ベストになる(以前はscorelogの最新行の更新前の値を使っていたため、
+        最終プレーで記録を更新しなかった曲では値が異なる)。
         """
         self.manage_results.load() # orh(ログ)を読み出した状態にしておく
         logger.info(f'現在の曲数:{len(self.manage_results.all_results)}, この時刻以降のリザルトを読み込む: {datetime.datetime.fromtimestamp(int(datetime.datetime.now().timestamp()) - self.config.autoload_offset*3600)}')
@@ -737,14 +1889,17 @@ class DataBaseAccessor:
             #log = self.df_scoredatalog[self.df_scoredatalog['date'] > cur_time.timestamp()]
             log = self.df_score
             logger.info(f'len(df_score): {len(log)}')
-            for index,row in log.iterrows():
-                tmp_result = self.parse(row)
-                if tmp_result:
+            self.manage_results.notify_results = False
+            try:
+                for tmp_result in self.parse_all(log):
                     self.manage_results.add_result(tmp_result)
+            finally:
+                self.manage_results.notify_results = True
         # 全件ロード後に統計情報更新を行い、today_resultsの更新もする
         self.manage_results.update_stats()
-        self.manage_results.all_results.sort()
-        self.manage_results.save()
+        with self.manage_results.file_lock: # 他のスレッドのadd_result()と同時に並び替えないように
+            self.manage_results.all_results.sort()
+        self.manage_results.compact() # 並び替えた結果を反映するため全体を書き直す
 
     def test_write_playlog(self):
         """テスト用。scoredatalogからparseして作ったDataFrameを書き出す
@@ -787,5 +1942,4 @@ if __name__ == '__main__':
     #acc.read_old_results()
     acc.manage_results.update_stats()
     acc.manage_results.save()
-    acc.manage_results.write_history_xml()
-    acc.manage_results.write_updates_xml()
+    acc.manage_results.write_xml()
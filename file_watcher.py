@@ -0,0 +1,229 @@
+# dbfileの更新監視
+import os
+import sys
+import time
+import select
+import struct
+import ctypes, ctypes.util
+import traceback
+
+import logging, logging.handlers
+os.makedirs('log', exist_ok=True)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+hdl = logging.handlers.RotatingFileHandler(
+    f'log/{os.path.basename(__file__).split(".")[0]}.log',
+    encoding='utf-8',
+    maxBytes=1024*1024*2,
+    backupCount=1,
+)
+hdl.setLevel(logging.DEBUG)
+hdl_formatter = logging.Formatter('%(asctime)s %(filename)s:%(lineno)5d %(funcName)s() [%(levelname)s] %(message)s')
+hdl.setFormatter(hdl_formatter)
+logger.addHandler(hdl)
+
+# inotify用の定数
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+
+# FindFirstChangeNotification用の定数
+FILE_NOTIFY_CHANGE_FILE_NAME  = 0x00000001
+FILE_NOTIFY_CHANGE_SIZE       = 0x00000008
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+WAIT_OBJECT_0 = 0x00000000
+WAIT_TIMEOUT = 0x00000102
+WAIT_FAILED = 0xFFFFFFFF
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+class DBFileWatcher:
+    """dbfileの更新を監視するクラス。
+    Linuxではinotify、WindowsではFindFirstChangeNotificationで変更を待ち受け、使えない場合はポーリングする。
+    -wal/-journalも監視対象とし、リザルト画面での一連の書き込みはdebounceして1回の通知にまとめる。
+    """
+    def __init__(self, debounce:float=0.5, max_delay:float=3.0, poll_interval:float=1.0):
+        """
+        Args:
+            debounce (float, optional): 最後の書き込みからこの秒数だけ変更が無ければ通知する。 Defaults to 0.5.
+            max_delay (float, optional): 書き込みが続いてもこの秒数が経ったら通知する。 Defaults to 3.0.
+            poll_interval (float, optional): ポーリング時の確認間隔。 Defaults to 1.0.
+        """
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.files = [] # 監視対象のファイル(-wal/-journalを含む)
+        self.backend = None # 'inotify', 'win32', 'poll'
+        self.last_signature = None
+        self.inotify_fd = None
+        self.win_handles = []
+
+    def set_files(self, dbfiles:list):
+        """監視対象のdbfileを設定する。対象が前回と同じなら何もしない。
+
+        Args:
+            dbfiles (list): dbfileのパスの配列
+        """
+        files = []
+        for f in dbfiles:
+            files += [f, f+'-wal', f+'-journal']
+        if files == self.files:
+            return
+        self.close()
+        self.files = files
+        self.last_signature = self.get_signature()
+        dirs = sorted(list(set(os.path.dirname(os.path.abspath(f)) for f in dbfiles)))
+        try:
+            if sys.platform.startswith('linux'):
+                self.init_inotify(dirs)
+            elif sys.platform == 'win32':
+                self.init_win32(dirs)
+            else:
+                self.backend = 'poll'
+        except Exception:
+            logger.error(traceback.format_exc())
+            self.close()
+            self.backend = 'poll'
+        logger.info(f"backend:{self.backend}, dirs:{dirs}")
+
+    def init_inotify(self, dirs:list):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.inotify_fd = fd
+        for d in dirs:
+            wd = libc.inotify_add_watch(fd, d.encode(), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed: {d}')
+        self.watch_names = set(os.path.basename(f) for f in self.files)
+        self.backend = 'inotify'
+
+    def init_win32(self, dirs:list):
+        kernel32 = ctypes.windll.kernel32
+        kernel32.FindFirstChangeNotificationW.restype = ctypes.c_void_p
+        for d in dirs:
+            handle = kernel32.FindFirstChangeNotificationW(d, False, FILE_NOTIFY_CHANGE_LAST_WRITE | FILE_NOTIFY_CHANGE_SIZE | FILE_NOTIFY_CHANGE_FILE_NAME)
+            if handle is None or handle == INVALID_HANDLE_VALUE:
+                raise OSError(f'FindFirstChangeNotification failed: {d}')
+            self.win_handles.append(handle)
+        self.backend = 'win32'
+
+    def close(self):
+        """監視用のハンドルを解放する"""
+        self.release_handles()
+        self.backend = None
+        self.files = []
+
+    def release_handles(self):
+        """inotify/win32のハンドルを解放する。監視対象のファイルはそのまま残す。"""
+        if self.inotify_fd is not None:
+            try:
+                os.close(self.inotify_fd)
+            except Exception:
+                pass
+            self.inotify_fd = None
+        for handle in self.win_handles:
+            try:
+                ctypes.windll.kernel32.FindCloseChangeNotification(ctypes.c_void_p(handle))
+            except Exception:
+                pass
+        self.win_handles = []
+
+    def fallback_to_poll(self):
+        """通知の待ち受けに失敗した場合、ハンドルを解放してポーリングに切り替える"""
+        self.release_handles()
+        self.backend = 'poll'
+        self.last_signature = self.get_signature()
+        logger.info("fallback to polling.")
+
+    def get_signature(self) -> list:
+        """監視対象の(更新時刻, サイズ)の一覧を返す。存在しないファイルはNone。"""
+        ret = []
+        for f in self.files:
+            try:
+                st = os.stat(f)
+                ret.append((st.st_mtime, st.st_size))
+            except OSError:
+                ret.append(None)
+        return ret
+
+    def is_changed(self) -> bool:
+        """前回の確認から監視対象のファイルが変化していればTrue"""
+        signature = self.get_signature()
+        ret = signature != self.last_signature
+        self.last_signature = signature
+        return ret
+
+    def wait_event(self, timeout:float) -> bool:
+        """監視対象への書き込みを最大timeout秒待つ
+
+        Args:
+            timeout (float): 待ち時間
+
+        Returns:
+            bool: 書き込みがあればTrue
+        """
+        if self.backend == 'inotify':
+            readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+            if not readable:
+                return False
+            ret = False
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except BlockingIOError:
+                return False
+            pos = 0
+            while pos+16 <= len(data):
+                wd, mask, cookie, size = struct.unpack_from('iIII', data, pos)
+                name = data[pos+16:pos+16+size].rstrip(b'\0').decode(errors='ignore')
+                pos += 16+size
+                if name in self.watch_names:
+                    ret = True
+            if ret:
+                self.last_signature = self.get_signature()
+            return ret
+        elif self.backend == 'win32':
+            kernel32 = ctypes.windll.kernel32
+            handles = (ctypes.c_void_p * len(self.win_handles))(*self.win_handles)
+            kernel32.WaitForMultipleObjects.restype = ctypes.c_uint32 # WAIT_FAILEDが-1にならないようにする
+            res = kernel32.WaitForMultipleObjects(len(self.win_handles), handles, False, int(timeout*1000))
+            if res == WAIT_TIMEOUT:
+                return False
+            if res < WAIT_OBJECT_0+len(self.win_handles):
+                kernel32.FindNextChangeNotification(ctypes.c_void_p(self.win_handles[res-WAIT_OBJECT_0]))
+                # フォルダ単位の通知なので、監視対象のファイルが変わったかどうかを確認する
+                return self.is_changed()
+            # WAIT_FAILEDなどの場合、待たずに戻ると呼び出し側が空回りするのでポーリングに切り替えて待つ
+            error = kernel32.GetLastError() if res == WAIT_FAILED else None
+            logger.error(f"WaitForMultipleObjects failed. (result:{res:#x}, GetLastError:{error})")
+            self.fallback_to_poll()
+            return self.wait_event(timeout)
+        else:
+            end = time.time() + timeout
+            while True:
+                if self.is_changed():
+                    return True
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(self.poll_interval, remaining))
+
+    def wait(self, timeout:float) -> bool:
+        """dbfileが更新されるまで最大timeout秒待つ。
+        更新を検知した後は書き込みが落ち着くまで待ってから返る。
+
+        Args:
+            timeout (float): 待ち時間
+
+        Returns:
+            bool: 更新があればTrue
+        """
+        if not self.wait_event(timeout):
+            return False
+        deadline = time.time() + self.max_delay
+        while time.time() < deadline:
+            if not self.wait_event(min(self.debounce, max(deadline-time.time(), 0))):
+                break
+        return True
@@ -12,6 +12,8 @@ import logging, logging.handlers
 import traceback
 import base64
 import io
+import hashlib
+from collections import deque
 from config import Config
 
 try:
@@ -96,14 +98,222 @@ class OBSControlData:
                 print(f"監視対象ソース設定読み込みエラー: {e}")
         return ""
 
+class ScreenMatcher:
+    """画像認識条件をコンパイルした判定クラス。
+    切り出し範囲・参照ハッシュ(ビット列をpackしたもの)・しきい値を配列で保持し、生成後は変更しない。
+    判定は各範囲を8x8のグレースケール配列にしてから、全条件分をまとめてビット化しハミング距離を求める。
+    結果はimagehash.average_hashで1条件ずつ比較した場合と同じ。
+    """
+    __slots__ = ('screen_types', 'boxes', 'ref_bits', 'thresholds', 'box_cache')
+    hash_size = 8 # imagehash.average_hashのデフォルト
+    min_crop_size = 32 # 縮小後の切り出し範囲がこれ以上の大きさになるようにキャプチャ幅を決める
+    POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8) # 1byteごとの立っているビット数
+    PRIORITY = ("play", "result", "select") # 複数の画面にマッチした場合の優先度
+
+    def __init__(self, recognition_settings: Dict[str, Dict[str, Any]], screen_types=("select", "play", "result")):
+        """
+        Args:
+            recognition_settings (dict): Config.recognition_settingsと同じ形式の判定条件
+            screen_types (tuple, optional): 判定対象の画面タイプ。 Defaults to ("select", "play", "result").
+        """
+        types, boxes, ref_bits, thresholds = [], [], [], []
+        for screen_type in screen_types:
+            condition = recognition_settings.get(screen_type)
+            if not condition:
+                continue
+            try:
+                coords = condition.get("coordinates", {})
+                x1, y1 = coords.get("x1", 0), coords.get("y1", 0)
+                x2, y2 = coords.get("x2", 100), coords.get("y2", 100)
+                reference_hash = imagehash.hex_to_hash(condition.get("hash", ""))
+                if reference_hash.hash.shape != (self.hash_size, self.hash_size):
+                    raise ValueError(f"unsupported hash size: {reference_hash.hash.shape}")
+                types.append(screen_type)
+                boxes.append((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+                ref_bits.append(np.packbits(reference_hash.hash.flatten()))
+                thresholds.append(condition.get("threshold", 10))
+            except Exception:
+                logger.error(f"invalid condition: {screen_type}\n{traceback.format_exc()}")
+        self.screen_types = tuple(types)
+        self.boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+        self.ref_bits = np.array(ref_bits, dtype=np.uint8).reshape(len(types), self.hash_size**2//8)
+        self.thresholds = np.array(thresholds, dtype=np.int64)
+        for a in (self.boxes, self.ref_bits, self.thresholds):
+            a.flags.writeable = False
+        self.box_cache = {} # (画像の大きさ, 元の大きさ) -> (判定対象の条件番号, 画像に合わせた切り出し範囲)
+
+    def get_capture_width(self, source_size) -> Optional[int]:
+        """判定に必要な解像度を保てる範囲で、最も小さいキャプチャ幅を返す。
+
+        Args:
+            source_size (tuple): 監視対象ソースの元の大きさ(width, height)
+
+        Returns:
+            Optional[int]: キャプチャ幅。縮小できない場合はNone。
+        """
+        if (source_size is None) or (len(self.screen_types) == 0):
+            return None
+        sizes = np.minimum(self.boxes[:, 2] - self.boxes[:, 0], self.boxes[:, 3] - self.boxes[:, 1])
+        scale = (self.min_crop_size / np.maximum(sizes, 1)).max()
+        if scale >= 1:
+            return None
+        return max(8, int(np.ceil(source_size[0] * scale))) # OBSの最小値は8
+
+    def get_distances(self, image: Image.Image, source_size=None) -> np.ndarray:
+        """各条件について、参照ハッシュとのハミング距離を返す。範囲が画面外の条件は-1。
+
+        Args:
+            image (Image.Image): スクリーンショット
+            source_size (tuple, optional): 縮小してキャプチャした場合、元の大きさ(width, height)。 Defaults to None.
+
+        Returns:
+            np.ndarray: 条件ごとのハミング距離
+        """
+        distances = np.full(len(self.screen_types), -1, dtype=np.int64)
+        idx, boxes = self.get_boxes(image.size, source_size or image.size)
+        if len(idx) == 0:
+            return distances
+        # フレーム全体をグレースケール化するより範囲ごとに変換する方が速い(結果は同じ)
+        pixels = np.stack([np.asarray(image.crop(box).convert('L').resize((self.hash_size, self.hash_size), Image.Resampling.LANCZOS)) for box in boxes])
+        bits = pixels > pixels.mean(axis=(1, 2), keepdims=True)
+        packed = np.packbits(bits.reshape(len(idx), -1), axis=1)
+        distances[idx] = self.POPCOUNT[packed ^ self.ref_bits[idx]].sum(axis=1)
+        return distances
+
+    def get_boxes(self, image_size, source_size) -> tuple:
+        """画面内に収まる条件の番号と、image_sizeに合わせて縮小した切り出し範囲を返す。同じ大きさについては使い回す。"""
+        key = (tuple(image_size), tuple(source_size))
+        if key not in self.box_cache.keys():
+            valid = (self.boxes[:, 2] <= source_size[0]) & (self.boxes[:, 3] <= source_size[1])
+            sx, sy = image_size[0] / source_size[0], image_size[1] / source_size[1]
+            boxes = []
+            for left, top, right, bottom in self.boxes[valid].tolist():
+                if (sx, sy) != (1, 1):
+                    left, top, right, bottom = int(left*sx), int(top*sy), int(np.ceil(right*sx)), int(np.ceil(bottom*sy))
+                    right, bottom = max(right, left+1), max(bottom, top+1)
+                boxes.append((left, top, right, bottom))
+            self.box_cache[key] = (np.flatnonzero(valid), boxes)
+        return self.box_cache[key]
+
+    def match(self, image: Image.Image, source_size=None) -> List[str]:
+        """スクリーンショットにマッチする画面タイプの一覧を返す
+
+        Args:
+            image (Image.Image): スクリーンショット
+            source_size (tuple, optional): 縮小してキャプチャした場合、元の大きさ(width, height)。座標をimageに合わせて縮小する。 Defaults to None.
+
+        Returns:
+            List[str]: マッチした画面タイプ
+        """
+        distances = self.get_distances(image, source_size)
+        matched = (distances >= 0) & (distances <= self.thresholds)
+        return [self.screen_types[i] for i in np.flatnonzero(matched)]
+
+    def recognize(self, image: Image.Image, source_size=None) -> Optional[str]:
+        """スクリーンショットに写っている画面タイプを1つ返す。複数マッチした場合はPRIORITYの順で決める。
+
+        Returns:
+            Optional[str]: 画面タイプ。どれにもマッチしない場合はNone。
+        """
+        detected_states = self.match(image, source_size)
+        for screen_type in self.PRIORITY:
+            if screen_type in detected_states:
+                return screen_type
+        return None
+
+class FrameChangeDetector:
+    """キャプチャしたjpegが、前回判定したフレームからほとんど変わっていないかを安価に判定するクラス。
+    1. base64文字列のダイジェストが前回と同じなら、デコードせずに変化なしとする
+    2. jpegのdraftモード(DCTの段階で縮小したデコード)で作ったサムネイルを前回判定したフレームと比べ、
+       画素値の差の最大値がthreshold以下なら変化なしとする
+    比較対象は最後に判定したフレームなので、少しずつ変化した場合もいずれ判定し直す。
+    サムネイルは常にthumb_sizeなので、キャプチャの大きさが変わった場合はjpeg自体の大きさで検出して判定し直す。
+    変化なしと判定した割合はget_metrics()で返す。
+    """
+    def __init__(self, thumb_size=(32, 18), threshold:int=12, max_skip_time:float=5.0, metrics_window:int=300):
+        """
+        Args:
+            thumb_size (tuple, optional): 比較するサムネイルの大きさ。 Defaults to (32, 18).
+            threshold (int, optional): 変化なしとみなすサムネイルの画素値の差(0-255)。 Defaults to 12.
+            max_skip_time (float, optional): 変化なしが続いてもこの秒数ごとに判定し直す。 Defaults to 5.0.
+            metrics_window (int, optional): スキップ率を求める直近のフレーム数。 Defaults to 300.
+        """
+        self.thumb_size = thumb_size
+        self.threshold = threshold
+        self.max_skip_time = max_skip_time
+        self.last_digest = None # 直前のフレームのダイジェスト
+        self.ref_thumb = None # 最後に判定したフレームのサムネイル
+        self.ref_size = None # 最後に判定したフレームの(縮小デコード前の)大きさ
+        self.ref_key = None # 最後に判定した時のkey(判定条件が変わったら判定し直す)
+        self.ref_time = None # 最後に判定した時刻
+        self.history = deque(maxlen=metrics_window) # フレームごとの結果('digest', 'thumb', None:判定した)
+
+    def reset(self):
+        self.last_digest = self.ref_thumb = self.ref_size = self.ref_key = self.ref_time = None
+
+    def get_thumbnail(self, image:Image.Image) -> np.ndarray:
+        """jpegをdraftモードで縮小デコードし、thumb_sizeのグレースケール配列にする"""
+        image.draft('L', (self.thumb_size[0]*2, self.thumb_size[1]*2)) # jpeg以外では何もしない
+        return np.asarray(image.convert('L').resize(self.thumb_size, Image.Resampling.BILINEAR), dtype=np.int16)
+
+    def check(self, payload:str, key=None, now:float=None) -> Optional[bytes]:
+        """フレームが変化したかを判定する
+
+        Args:
+            payload (str): GetSourceScreenshotのimage_data(base64、data:image/...の接頭辞は除いたもの)
+            key (optional): 判定条件や縮小前の大きさなどを表す値。前回と異なる場合は必ず変化ありとする。 Defaults to None.
+            now (float, optional): 現在時刻。 Defaults to None.
+
+        Returns:
+            Optional[bytes]: 変化ありの場合はデコードした画像データ、変化なしの場合はNone
+        """
+        now = time.time() if now is None else now
+        digest = hashlib.sha1(payload.encode('ascii')).digest()
+        fresh = (self.ref_thumb is not None) and (key == self.ref_key) and (now - self.ref_time < self.max_skip_time)
+        if fresh and (digest == self.last_digest):
+            self.history.append('digest')
+            return None
+        self.last_digest = digest
+        data = base64.b64decode(payload)
+        image = Image.open(io.BytesIO(data))
+        size = image.size # draft()する前の大きさ
+        thumb = self.get_thumbnail(image)
+        if fresh and (size == self.ref_size) and (np.abs(thumb - self.ref_thumb).max() <= self.threshold):
+            self.history.append('thumb')
+            return None
+        self.ref_thumb = thumb
+        self.ref_size = size
+        self.ref_key = key
+        self.ref_time = now
+        self.history.append(None)
+        return data
+
+    def get_metrics(self) -> dict:
+        """直近metrics_windowフレームのスキップ率を返す
+
+        Returns:
+            dict: {'frames':フレーム数, 'skip_ratio':スキップした割合, 'digest':ダイジェストでスキップした数, 'thumb':サムネイルでスキップした数}
+        """
+        history = list(self.history)
+        digest, thumb = history.count('digest'), history.count('thumb')
+        return {
+            'frames':len(history),
+            'skip_ratio':(digest+thumb)/len(history) if history else 0.0,
+            'digest':digest,
+            'thumb':thumb,
+        }
+
 class ImageRecognitionData:
     """画像認識設定のデータ管理クラス"""
+    revision = 0 # save_condition()のたびに増やす。全インスタンスで共有し、ScreenMatcherを作り直すかどうかの判定に使う
     
     def __init__(self, config:Config=None, image_dir="recognition_images"):
         if config is None:
             config = Config()
         self.config = config
         self.image_dir = image_dir
+        self.matcher = None
+        self.matcher_revision = None
         
         # 画像保存ディレクトリを作成
         if not os.path.exists(self.image_dir):
@@ -128,6 +338,7 @@ class ImageRecognitionData:
             }
             
             self.config.save_config()
+            ImageRecognitionData.revision += 1
             return True
             
         except Exception as e:
@@ -146,6 +357,13 @@ class ImageRecognitionData:
         """すべての条件を取得"""
         return self.config.recognition_settings
 
+    def get_matcher(self) -> ScreenMatcher:
+        """コンパイル済みの判定条件を返す。save_condition()で条件が変わった場合のみ作り直す。"""
+        if (self.matcher is None) or (self.matcher_revision != ImageRecognitionData.revision):
+            self.matcher = ScreenMatcher(self.config.recognition_settings)
+            self.matcher_revision = ImageRecognitionData.revision
+        return self.matcher
+
 class OBSControlWindow:
     """OBS制御設定ウィンドウ"""
     
@@ -1522,6 +1740,9 @@ class OBSWebSocketManager:
         self.connection_thread = None
         self.should_reconnect = False
         self.config = None
+        self.source_size = None # 監視対象ソースの元の大きさ。{'name':ソース名, 'size':(width, height), 'time':取得時刻}
+        self.source_size_interval = 60 # ソースの大きさを取り直す間隔(秒)
+        self.screenshot_quality = 50 # 縮小キャプチャ時のjpeg品質
         
         # ログ設定
         self.logger = logging.getLogger(__name__)
@@ -1825,10 +2046,34 @@ class OBSWebSocketManager:
             return False
 
     # 設定されたソースを取得し、PIL.Image形式で返す
-    def get_screenshot(self):
-        img = self.client.get_source_screenshot(self.config.monitor_source_name, 'jpeg', None, None, 100)
+    def get_screenshot(self, width=None, quality=100):
+        """監視対象ソースのスクリーンショットを取得する
+
+        Args:
+            width (int, optional): 縮小後の幅。高さは縦横比を保ってOBS側で決まる。Noneの場合は元の大きさ。 Defaults to None.
+            quality (int, optional): jpegの品質。 Defaults to 100.
+        """
+        img = self.client.get_source_screenshot(self.config.monitor_source_name, 'jpeg', width, None, quality)
         return img
 
+    def get_source_size(self):
+        """監視対象ソースの元の大きさ(width, height)を返す。
+        最低品質のスクリーンショットのヘッダから求め、source_size_interval秒の間は使い回す。
+        """
+        name = self.config.monitor_source_name
+        if (self.source_size is None) or (self.source_size['name'] != name) or (time.time() - self.source_size['time'] > self.source_size_interval):
+            try:
+                res = self.client.get_source_screenshot(name, 'jpeg', None, None, 0)
+                image_data_str = res.image_data
+                if image_data_str.startswith('data:image/'):
+                    image_data_str = image_data_str.split(',')[1]
+                size = Image.open(io.BytesIO(base64.b64decode(image_data_str))).size # ヘッダのみ読む
+                self.source_size = {'name':name, 'size':size, 'time':time.time()}
+            except Exception:
+                logger.debug(traceback.format_exc())
+                return None
+        return self.source_size['size']
+
     def enable_source(self, scenename, sourceid): # グループ内のitemはscenenameにグループ名を指定する必要があるので注意
         try:
             res = self.client.set_scene_item_enabled(scenename, sourceid, enabled=True)
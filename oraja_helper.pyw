@@ -1,6 +1,7 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 import threading
+import multiprocessing
 import subprocess
 import time
 import os, sys
@@ -11,8 +12,13 @@ import io
 import datetime
 from config import Config
 from settings import SettingsWindow
-from obs_control import OBSControlWindow, ImageRecognitionData, OBSWebSocketManager
+from obs_control import OBSControlWindow, ImageRecognitionData, OBSWebSocketManager, FrameChangeDetector
 from dataclass import *
+from file_watcher import DBFileWatcher
+from overlay_server import OverlayServer
+from screen_sampler import ScreenSampler
+from state_filter import GameStateFilter
+from recognition_process import RecognitionProcess
 from pickle_converter import *
 import requests
 from bs4 import BeautifulSoup
@@ -148,6 +154,14 @@ class MainWindow:
         self.file_exists = False
         self.current_game_state = None  # None, "select", "play", "result"
         
+        # 画像認識条件。判定条件はコンパイルしたものを使い回す
+        self.image_recognition_data = ImageRecognitionData(self.config)
+        self.screen_sampler = ScreenSampler() # ゲーム状態に応じて画面認識の間隔を変える
+        self.state_filter = GameStateFilter.from_settings(self.config.state_filter_settings) # 画面認識のちらつきで状態が変わらないようにする
+        self.frame_detector = FrameChangeDetector() # 前回判定したフレームから変化が無ければデコードと判定を省略する
+        self.detected_game_state = None # 最後に判定したフレームの認識結果(フィルタ前)
+        self.recognition_process = RecognitionProcess() # デコードや判定はGILを取り合わないように別プロセスで行う
+
         # OBS WebSocket管理クラス初期化
         self.obs_manager = OBSWebSocketManager(status_callback=self.on_obs_status_changed)
         self.obs_manager.set_config(self.config)
@@ -156,8 +170,11 @@ class MainWindow:
         self.database_accessor = DataBaseAccessor()
         self.database_accessor.set_config(self.config)
         # self.database_accessor.read_old_results()
-        self.database_accessor.manage_results.write_history_xml()
-        self.database_accessor.manage_results.write_updates_xml()
+        self.database_accessor.manage_results.write_xml()
+
+        # overlay配信用HTTPサーバ。リザルト追加やXML更新をSSEで通知する
+        self.overlay_server = None
+        self.update_overlay_server()
         
         self.setup_ui()
         self.set_embedded_icon()
@@ -344,6 +361,9 @@ class MainWindow:
     def start_all_threads(self):
         """全スレッドを開始"""
         self.start_db_monitoring()
+        # 画像認識はOBSから受け取ったフレームに対してのみ行うので、OBS連携が無効の場合は子プロセスを起動しない
+        if self.config.enable_websocket and self.config.enable_register_conditions and IMAGEHASH_AVAILABLE:
+            self.recognition_process.start_async() # 準備ができるまでGUIを止めないよう別スレッドで起動する
         self.start_screen_monitoring()
     
     def start_db_monitoring(self):
@@ -363,29 +383,36 @@ class MainWindow:
     def db_monitoring_worker(self):
         """dbfile監視専用ワーカースレッド"""
         print("dbfile監視スレッド開始")
+        watcher = DBFileWatcher()
         while self.is_running:
             try:
                 if self.database_accessor.is_valid():
-                    if self.database_accessor.reload_db():
+                    # 書き込みがあるまでブロックする。一連の書き込みが終わってから1回だけ読み込む
+                    watcher.set_files(self.database_accessor.get_watch_files())
+                    # 前回の取り込みが例外で中断した場合は、dbに書き込みが無くても読み直す
+                    if (watcher.wait(timeout=5) and self.database_accessor.reload_db()) or self.database_accessor.has_unread_results():
                         self.update_db_status()
-                        self.database_accessor.read_one_result()
+                        # 前回以降に増えたリザルトを全て登録し、保存やXML出力はまとめて1回だけ行う
+                        if len(self.database_accessor.read_new_results()) == 0:
+                            continue
+                        self.screen_sampler.notify_result() # リザルト画面への遷移をすぐに確認させる
                         self.database_accessor.manage_results.update_stats()
                         self.database_accessor.manage_results.save()
-                        self.database_accessor.manage_results.write_history_xml()
-                        self.database_accessor.manage_results.write_updates_xml()
+                        self.database_accessor.manage_results.write_xml()
                         logger.info(f"added! len(all_results):{len(self.database_accessor.manage_results.all_results)}, len(today_results):{len(self.database_accessor.manage_results.today_results)}")
                         self.update_stats_gui()
                         logger.info(f"added! len(all_results):{len(self.database_accessor.manage_results.all_results)}, len(today_results):{len(self.database_accessor.manage_results.today_results)}")
                     
                 else:
                     self.file_exists = False
+                    time.sleep(1)
                 
             except Exception as e:
                 print(f"ファイル監視エラー: {e}")
                 # self.root.after(0, lambda: self.status_var.set(f"ファイル監視エラー: {e}"))
-            # 
-            time.sleep(1)
+                time.sleep(1)
         
+        watcher.close()
         print("ファイル監視スレッド終了")
     
     def screen_monitoring_worker(self):
@@ -393,22 +420,26 @@ class MainWindow:
         print("画面監視スレッド開始")
         while self.is_running:
             try:
+                interval = 1 # 1秒間隔で実行
                 # OBSWebSocket設定がされている場合のみ実行
                 if (self.config.enable_websocket and 
                     self.obs_manager.is_connected):
                     
                     # 画像認識が有効な場合：OBSスクリーンショットによる判定
                     if self.config.enable_register_conditions:
-                        screenshot_data = self.get_obs_screenshot()
-                        if screenshot_data:
-                            self.detect_game_state_from_screenshot(screenshot_data)
+                        self.screen_sampler.begin_sample()
+                        source_size = self.obs_manager.get_source_size()
+                        payload = self.get_obs_screenshot(source_size)
+                        if payload and IMAGEHASH_AVAILABLE:
+                            self.detected_game_state = self.recognize_payload(payload, source_size)
+                            self.update_game_state(self.detected_game_state)
+                        interval = None # 状態に応じた間隔で実行(遷移が起きそうな時は短く、プレー中は長く)
                     
                     # 画像認識が無効な場合：ファイルベースの判定
                     else:
                         self.detect_game_state_from_file()
                 
-                # 1秒間隔で実行
-                time.sleep(1)
+                self.screen_sampler.wait(interval)
                 
             except Exception as e:
                 print(f"画面監視エラー: {e}")
@@ -417,24 +448,25 @@ class MainWindow:
         
         print("画面監視スレッド終了")
     
-    def get_obs_screenshot(self):
-        """OBSからスクリーンショットを取得"""
+    def get_obs_screenshot(self, source_size=None):
+        """OBSからスクリーンショットを取得し、base64文字列のまま返す(デコードはFrameChangeDetectorで変化があった場合のみ行う)。
+        source_sizeが分かる場合は、判定条件の範囲を判定できる大きさまで縮小した低品質のjpegを取得する。"""
         if not PIL_AVAILABLE:
             return None
             
         try:
             # OBSの現在のプログラム出力のスクリーンショットを取得
-            result = self.obs_manager.get_screenshot()
+            width = self.image_recognition_data.get_matcher().get_capture_width(source_size) if IMAGEHASH_AVAILABLE else None
+            if width is None:
+                result = self.obs_manager.get_screenshot()
+            else:
+                result = self.obs_manager.get_screenshot(width, self.obs_manager.screenshot_quality)
             
             if result and hasattr(result, 'image_data'):
-                # Base64デコードして画像データを返す
                 image_data_str = result.image_data
                 if image_data_str.startswith('data:image/'):
                     image_data_str = image_data_str.split(',')[1]
-                
-                image_data = base64.b64decode(image_data_str)
-                image = Image.open(io.BytesIO(image_data))
-                return image
+                return image_data_str
             
         except Exception as e:
             print(f"OBSスクリーンショット取得エラー: {e}")
@@ -454,34 +486,44 @@ class MainWindow:
             print(f"プレイ時間を追加: {play_duration}, 累計: {self.database_accessor.manage_results.playtime}")
             self.play_st = None
 
-    def detect_game_state_from_screenshot(self, screenshot_image):
-        """スクリーンショットからゲーム状態を判定"""
+    def detect_game_state_from_screenshot(self, screenshot_image, source_size=None):
+        """スクリーンショットからゲーム状態を判定。縮小キャプチャの場合はsource_sizeに元の大きさを渡す。"""
         if not IMAGEHASH_AVAILABLE:
             return
-            
+        self.detected_game_state = self.recognize_game_state(screenshot_image, source_size)
+        self.update_game_state(self.detected_game_state)
+
+    def recognize_payload(self, payload, source_size=None):
+        """OBSから受け取ったフレームを画像認識用プロセスで判定する。プロセスを使えない場合はこのプロセスで判定する。"""
+        ok, state = self.recognition_process.recognize(payload, source_size, ImageRecognitionData.revision, self.config.recognition_settings)
+        if ok:
+            return state
+        data = self.frame_detector.check(payload, (ImageRecognitionData.revision, source_size)) # 判定条件か縮小前の大きさが変わったら必ず判定する
+        if data is None: # 変化が無い場合は前回の認識結果を使う
+            return self.detected_game_state
+        return self.recognize_game_state(Image.open(io.BytesIO(data)), source_size)
+
+    def recognize_game_state(self, screenshot_image, source_size=None):
+        """1フレーム分のスクリーンショットに写っている画面を返す。判定できない場合は前回の認識結果を返す。"""
         try:
-            # 画像認識データを読み込み
-            recognition_data = ImageRecognitionData()
-            
-            new_state = None
-            detected_states = []
-            
-            # 各画面タイプの判定を実行
-            for screen_type in ["select", "play", "result"]:
-                condition = recognition_data.get_condition(screen_type)
-                if condition and self.check_screen_match(screenshot_image, condition):
-                    detected_states.append(screen_type)
-            
-            # 複数の状態が検出された場合は優先度で決定（プレー > リザルト > 選曲）
-            if "play" in detected_states:
-                new_state = "play"
-            elif "result" in detected_states:
-                new_state = "result"
-            elif "select" in detected_states:
-                new_state = "select"
-            
+            # コンパイル済みの判定条件で判定し、複数の状態が検出された場合は優先度で決定（プレー > リザルト > 選曲）
+            return self.image_recognition_data.get_matcher().recognize(screenshot_image, source_size)
+        except Exception as e:
+            print(f"ゲーム状態判定エラー: {e}")
+            return self.detected_game_state
+
+    def update_game_state(self, new_state):
+        """画像認識の結果をフィルタに通し、状態の変化が確定した場合にトリガーを実行する"""
+        try:
+            # 数フレーム続いた許可された遷移のみ確定させる
+            if self.state_filter.state != self.current_game_state: # ファイルベースの判定から切り替えた場合など
+                self.state_filter.reset(self.current_game_state)
+            transition = self.state_filter.update(new_state)
+            self.screen_sampler.pending = self.state_filter.pending
+
             # 状態が変化した場合のみ処理
-            if new_state != self.current_game_state:
+            if transition is not None:
+                new_state = transition[1]
 
                 # 前の状態の終了処理
                 if self.current_game_state:
@@ -494,53 +536,19 @@ class MainWindow:
                 if new_state:
                     self.execute_obs_trigger(f"{new_state}_start")
 
+                self.screen_sampler.on_transition(self.current_game_state, new_state)
                 self.current_game_state = new_state
                 
                 # UI更新
                 self.root.after(0, self.update_game_state_display)
                 
                 print(f"ゲーム状態変化（画像認識）: {self.current_game_state}")
+                frame_metrics = self.recognition_process.get_metrics() or self.frame_detector.get_metrics()
+                logger.info(f"frame skip ratio:{frame_metrics['skip_ratio']:.2f} (digest:{frame_metrics['digest']}, thumb:{frame_metrics['thumb']}, frames:{frame_metrics['frames']})")
                 
         except Exception as e:
             print(f"ゲーム状態判定エラー: {e}")
     
-    def check_screen_match(self, screenshot_image, condition):
-        """スクリーンショットが指定された画面条件にマッチするかチェック"""
-        try:
-            # 座標情報を取得
-            coords = condition.get("coordinates", {})
-            x1, y1 = coords.get("x1", 0), coords.get("y1", 0)
-            x2, y2 = coords.get("x2", 100), coords.get("y2", 100)
-            
-            # 座標を正規化
-            left, top = min(x1, x2), min(y1, y2)
-            right, bottom = max(x1, x2), max(y1, y2)
-            
-            # スクリーンショットのサイズチェック
-            img_width, img_height = screenshot_image.size
-            if right > img_width or bottom > img_height:
-                return False
-            
-            # スクリーンショットから該当範囲を切り出し
-            cropped = screenshot_image.crop((left, top, right, bottom))
-            
-            # ハッシュを計算
-            current_hash = imagehash.average_hash(cropped)
-            
-            # 設定されたハッシュと比較
-            reference_hash = imagehash.hex_to_hash(condition.get("hash", ""))
-            threshold = condition.get("threshold", 10)
-            
-            # ハッシュの差分を計算
-            hash_diff = current_hash - reference_hash
-            
-            # しきい値以下なら一致とみなす
-            return hash_diff <= threshold
-            
-        except Exception as e:
-            print(f"画面マッチング判定エラー: {e}")
-            return False
-    
     def detect_game_state_from_file(self):
         """ファイルベースのゲーム状態判定"""
         try:
@@ -590,6 +598,22 @@ class MainWindow:
         self.notes_var.set(str(self.database_accessor.manage_results.notes))
         self.score_rate_var.set(f"{self.database_accessor.manage_results.score_rate:.2f}%")
 
+    def update_overlay_server(self):
+        """設定に合わせてoverlay配信用HTTPサーバを起動/停止する"""
+        if self.overlay_server is not None:
+            if self.config.enable_overlay_server and (self.overlay_server.port == self.config.overlay_server_port):
+                return
+            self.database_accessor.manage_results.remove_listener(self.overlay_server.publish)
+            self.overlay_server.stop()
+            self.overlay_server = None
+        if self.config.enable_overlay_server:
+            server = OverlayServer(port=self.config.overlay_server_port, delta_func=self.database_accessor.manage_results.get_delta)
+            if server.start():
+                self.overlay_server = server
+                self.database_accessor.manage_results.add_listener(server.publish)
+            else:
+                print(f"overlay配信サーバを起動できませんでした(port:{self.config.overlay_server_port})")
+
     def update_config_display(self):
         """設定情報の表示を更新"""
         self.oraja_path_var.set(self.config.oraja_path or "未設定")
@@ -601,11 +625,11 @@ class MainWindow:
         self.database_accessor.set_config(self.config)
         logger.info(f"added! len(all_results):{len(self.database_accessor.manage_results.all_results)}, len(today_results):{len(self.database_accessor.manage_results.today_results)}")
         self.update_db_status()
+        self.update_overlay_server()
 
         # 設定画面で更新される可能性があるため、DataBaseAccessorをリロードしておく
         self.database_accessor.manage_results.load()
-        self.database_accessor.manage_results.write_history_xml()
-        self.database_accessor.manage_results.write_updates_xml()
+        self.database_accessor.manage_results.write_xml()
 
         self.playcount_var.set(str(self.database_accessor.manage_results.playcount))
         self.notes_var.set(str(self.database_accessor.manage_results.notes))
@@ -823,7 +847,7 @@ class MainWindow:
     def open_settings(self):
         """設定ダイアログを開く"""
         self.database_accessor.manage_results.save()
-        settings_window = SettingsWindow(self.root, self.config, self.update_config_display)
+        settings_window = SettingsWindow(self.root, self.config, self.update_config_display, manage_results=self.database_accessor.manage_results)
     
     def open_obs_control(self):
         """OBS制御設定ダイアログを開く"""
@@ -845,8 +869,7 @@ class MainWindow:
 
         # xml出力
         self.database_accessor.manage_results.save()
-        self.database_accessor.manage_results.write_history_xml()
-        self.database_accessor.manage_results.write_updates_xml()
+        self.database_accessor.manage_results.write_xml()
 
         # tweet
         if self.config.enable_autotweet:
@@ -866,6 +889,10 @@ class MainWindow:
             self.obs_manager.stop_auto_reconnect()
             self.obs_manager.disconnect()
         
+        # overlay配信サーバを停止
+        if getattr(self, 'overlay_server', None) is not None:
+            self.overlay_server.stop()
+
         # スレッドの終了を待機
         if self.db_monitoring_thread and self.db_monitoring_thread.is_alive():
             print("ファイル監視スレッドの終了を待機中...")
@@ -874,6 +901,9 @@ class MainWindow:
         if self.screen_monitoring_thread and self.screen_monitoring_thread.is_alive():
             print("画面監視スレッドの終了を待機中...")
             self.screen_monitoring_thread.join(timeout=2)
+
+        # 画像認識用プロセスを停止
+        self.recognition_process.stop()
         
         # アプリケーションロックを解放
         if hasattr(self, 'app_lock'):
@@ -896,6 +926,7 @@ class MainWindow:
                 self.app_lock.release_lock()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # exe化した際にプロセスプールを使うため
     # app = MainWindow() # debug
     # app.run()
     try:
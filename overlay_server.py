@@ -0,0 +1,210 @@
+# OBSのブラウザソース向けのHTTPサーバ
+# overlayのhtml/xmlを配信し、リザルト追加時にServer-Sent Eventsで通知する
+import os
+import json
+import queue
+import threading
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote, parse_qs
+
+import logging, logging.handlers
+os.makedirs('log', exist_ok=True)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+hdl = logging.handlers.RotatingFileHandler(
+    f'log/{os.path.basename(__file__).split(".")[0]}.log',
+    encoding='utf-8',
+    maxBytes=1024*1024*2,
+    backupCount=1,
+)
+hdl.setLevel(logging.DEBUG)
+hdl_formatter = logging.Formatter('%(asctime)s %(filename)s:%(lineno)5d %(funcName)s() [%(levelname)s] %(message)s')
+hdl.setFormatter(hdl_formatter)
+logger.addHandler(hdl)
+
+class OverlayRequestHandler(BaseHTTPRequestHandler):
+    """OverlayServer用のリクエストハンドラ。self.server.overlayからOverlayServerを参照する。"""
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        overlay = self.server.overlay
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        if path == '/events':
+            self.send_events(overlay)
+        elif path == '/api/results':
+            self.send_delta(overlay, parse_qs(url.query))
+        else:
+            self.send_static(overlay, path)
+
+    def send_static(self, overlay, path:str):
+        """root_dir以下のファイルを返す。拡張子がCONTENT_TYPESに無いものは返さない(config.jsonなど)。"""
+        if path == '/':
+            path = '/info.html'
+        filename = os.path.realpath(os.path.join(overlay.root_dir, path.lstrip('/')))
+        ext = os.path.splitext(filename)[1].lower()
+        if (os.path.commonpath([overlay.root_dir, filename]) != overlay.root_dir) or (ext not in overlay.CONTENT_TYPES.keys()) or (not os.path.isfile(filename)):
+            self.send_error(404)
+            return
+        with open(filename, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', overlay.CONTENT_TYPES[ext])
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_delta(self, overlay, query:dict):
+        """?since=<seq>以降のリザルトの差分をJSONで返す"""
+        if overlay.delta_func is None:
+            self.send_error(404)
+            return
+        try:
+            since = int(query['since'][0])
+        except (KeyError, ValueError, IndexError):
+            since = None
+        body = overlay.dumps(overlay.delta_func(since)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, overlay):
+        """Server-Sent Eventsのストリームを返す。接続が切れるかサーバが止まるまで戻らない。"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'keep-alive')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        q = overlay.add_client()
+        try:
+            self.wfile.write(b'retry: 1000\n\n')
+            self.wfile.flush()
+            while True:
+                try:
+                    msg = q.get(timeout=overlay.keepalive)
+                except queue.Empty:
+                    msg = b': keepalive\n\n'
+                if msg is None: # サーバ停止
+                    break
+                self.wfile.write(msg)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            pass
+        finally:
+            overlay.remove_client(q)
+
+class OverlayServer:
+    """overlay用のhtml/xmlを配信し、Server-Sent Eventsで更新を通知するHTTPサーバ。
+    ブラウザソースからはhttp://localhost:port/info.html のように開く。
+    delta_funcを指定した場合、/api/results?since=<seq> でリザルトの差分をJSONで返す。
+    """
+    CONTENT_TYPES = {
+        '.html': 'text/html; charset=utf-8',
+        '.xml':  'application/xml; charset=utf-8',
+        '.css':  'text/css; charset=utf-8',
+        '.js':   'text/javascript; charset=utf-8',
+        '.png':  'image/png',
+        '.jpg':  'image/jpeg',
+        '.gif':  'image/gif',
+        '.svg':  'image/svg+xml',
+        '.ico':  'image/x-icon',
+        '.ttf':  'font/ttf',
+        '.otf':  'font/otf',
+        '.woff': 'font/woff',
+        '.woff2':'font/woff2',
+    }
+
+    def __init__(self, root_dir:str='.', host:str='127.0.0.1', port:int=8765, keepalive:float=15.0, delta_func=None):
+        """
+        Args:
+            root_dir (str, optional): 配信するファイルを置いたフォルダ。 Defaults to '.'.
+            host (str, optional): 待ち受けるアドレス。 Defaults to '127.0.0.1'.
+            port (int, optional): 待ち受けるポート。 Defaults to 8765.
+            keepalive (float, optional): イベントが無い場合にコメントを送る間隔。 Defaults to 15.0.
+            delta_func (function, optional): since(int or None)を受け取り差分のdictを返す関数(ManageResults.get_delta)。 Defaults to None.
+        """
+        self.root_dir = os.path.realpath(root_dir)
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.delta_func = delta_func
+        self.httpd = None
+        self.thread = None
+        self.clients = set() # 接続中のクライアントごとの送信キュー
+        self.lock = threading.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return self.httpd is not None
+
+    def start(self) -> bool:
+        """サーバを起動する
+
+        Returns:
+            bool: 起動できた場合True
+        """
+        if self.is_running:
+            return True
+        try:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), OverlayRequestHandler)
+        except OSError:
+            logger.error(traceback.format_exc())
+            self.httpd = None
+            return False
+        self.httpd.daemon_threads = True
+        self.httpd.overlay = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"overlay server started. (http://{self.host}:{self.port}/)")
+        return True
+
+    def stop(self):
+        """サーバを停止し、接続中のクライアントを切断する"""
+        if not self.is_running:
+            return
+        with self.lock:
+            for q in self.clients:
+                q.put(None)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join(timeout=2)
+        self.httpd = None
+        self.thread = None
+        logger.info("overlay server stopped.")
+
+    def add_client(self) -> queue.Queue:
+        q = queue.Queue()
+        with self.lock:
+            self.clients.add(q)
+        return q
+
+    def remove_client(self, q:queue.Queue):
+        with self.lock:
+            self.clients.discard(q)
+
+    @staticmethod
+    def dumps(data) -> str:
+        """numpyの数値型を含むデータもJSONに変換する。NaNはブラウザで読めないJSONになるので例外にする。"""
+        return json.dumps(data, ensure_ascii=False, allow_nan=False, default=lambda x: x.item() if hasattr(x, 'item') else str(x))
+
+    def publish(self, event:str, data):
+        """接続中の全クライアントにイベントを送る。ManageResultsのlistenerとして登録して使う。
+
+        Args:
+            event (str): イベント名
+            data: JSONに変換できるデータ
+        """
+        if not self.is_running:
+            return
+        msg = f"event: {event}\ndata: {self.dumps(data)}\n\n".encode('utf-8')
+        with self.lock:
+            for q in self.clients:
+                q.put(msg)
@@ -0,0 +1,224 @@
+# 画面認識を別プロセスで行うためのクラス
+# jpegのデコードや切り出し・ハッシュ計算をTkやdb監視と同じプロセスで行うとGILを取り合ってGUIが引っかかるため、
+# OBSから受け取ったフレームを子プロセスに送り、認識結果(画面タイプ)だけを受け取る。
+import os
+import io
+import time
+import threading
+import traceback
+import multiprocessing
+
+import logging, logging.handlers
+os.makedirs('log', exist_ok=True)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+hdl = logging.handlers.RotatingFileHandler(
+    f'log/{os.path.basename(__file__).split(".")[0]}.log',
+    encoding='utf-8',
+    maxBytes=1024*1024*2,
+    backupCount=1,
+)
+hdl.setLevel(logging.DEBUG)
+hdl_formatter = logging.Formatter('%(asctime)s %(filename)s:%(lineno)5d %(funcName)s() [%(levelname)s] %(message)s')
+hdl.setFormatter(hdl_formatter)
+logger.addHandler(hdl)
+
+def recognition_worker(conn):
+    """子プロセスのメインループ。親プロセスからのメッセージを順に処理する。
+
+    importなどの準備が終わったら('ready',)を送る。
+
+    受け取るメッセージ:
+        ('conditions', revision, recognition_settings): 判定条件を更新する
+        ('frame', payload, source_size): フレームを判定し、('state', 画面タイプ)を返す
+        ('metrics',): ('metrics', FrameChangeDetector.get_metrics())を返す
+        None: 終了する
+    """
+    from PIL import Image
+    from obs_control import ScreenMatcher, FrameChangeDetector
+    matcher = ScreenMatcher({})
+    revision = None
+    detector = FrameChangeDetector()
+    state = None
+    conn.send(('ready',))
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError): # 親プロセスが終了した
+            break
+        if msg is None:
+            break
+        try:
+            if msg[0] == 'conditions':
+                revision = msg[1]
+                matcher = ScreenMatcher(msg[2])
+            elif msg[0] == 'frame':
+                data = detector.check(msg[1], (revision, msg[2])) # 判定条件か縮小前の大きさが変わったら必ず判定する
+                if data is not None: # 変化が無い場合は前回の認識結果を返す
+                    state = matcher.recognize(Image.open(io.BytesIO(data)), msg[2])
+                conn.send(('state', state))
+            elif msg[0] == 'metrics':
+                conn.send(('metrics', detector.get_metrics()))
+        except Exception:
+            logger.error(traceback.format_exc())
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+class RecognitionProcess:
+    """画面認識用の子プロセスを管理するクラス。
+    recognize()は画面監視スレッドからのみ呼ぶ。未起動の場合や子プロセスが落ちた場合は、stop()するまでrestart_interval秒ごとに
+    別スレッドで起動し直す。起動して準備ができるまでの間、recognize()は(False, None)を返すので、呼び出し側で判定する。
+    """
+    def __init__(self, timeout:float=2.0, restart_interval:float=10.0, ready_timeout:float=60.0):
+        """
+        Args:
+            timeout (float, optional): 認識結果を待つ最大秒数。 Defaults to 2.0.
+            restart_interval (float, optional): 子プロセスを起動し直す間隔。 Defaults to 10.0.
+            ready_timeout (float, optional): 子プロセスの起動(importなど)を待つ最大秒数。 Defaults to 60.0.
+        """
+        self.timeout = timeout
+        self.ready_timeout = ready_timeout
+        self.restart_interval = restart_interval
+        self.process = None
+        self.conn = None
+        self.sent_revision = None # 子プロセスに送った判定条件のrevision
+        self.last_start_time = None
+        self.stopped = False # stop()で明示的に止めた場合True
+        self.starting = False # 起動して準備完了を待っている間True
+        self.ready = False # 子プロセスの準備ができ、判定を依頼できる場合True
+        self.lock = threading.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return (self.process is not None) and self.process.is_alive()
+
+    def start(self, restart:bool=False) -> bool:
+        """子プロセスを起動し、準備ができるまで待つ。
+        起動直後はimportなどに時間がかかるため、timeoutではなくready_timeoutまで待つ。
+        待つ間はlockを持たないので、他のスレッドのrecognize()は止まらない。
+
+        Args:
+            restart (bool, optional): recognize()から起動し直す場合True。stop()した後は起動しない。 Defaults to False.
+
+        Returns:
+            bool: 起動して準備ができた場合True
+        """
+        with self.lock:
+            if restart and self.stopped:
+                return False
+            self.stopped = False
+            if self.is_running or self.starting:
+                return self.is_running and self.ready
+            self._close()
+            self.last_start_time = time.time()
+            try:
+                parent_conn, child_conn = multiprocessing.Pipe()
+                self.process = multiprocessing.Process(target=recognition_worker, args=(child_conn,), daemon=True)
+                self.process.start()
+                child_conn.close()
+                self.conn = parent_conn
+            except Exception:
+                logger.error(traceback.format_exc())
+                self._close()
+                return False
+            self.starting = True
+            process, conn = self.process, self.conn
+
+        ok = False
+        try:
+            ok = conn.poll(self.ready_timeout) and (conn.recv()[0] == 'ready')
+        except Exception: # 子プロセスがimportなどで落ちた場合や、待つ間にstop()された場合
+            logger.error(traceback.format_exc())
+        with self.lock:
+            self.starting = False
+            if self.process is not process: # 待つ間にstop()された
+                return False
+            if not ok:
+                logger.error("recognition process did not become ready.")
+                self._close()
+                return False
+            self.ready = True
+            logger.info(f"recognition process started. (pid:{self.process.pid})")
+            return True
+
+    def start_async(self, restart:bool=False):
+        """start()を別スレッドで行う。GUIや画面監視スレッドから起動する場合に使う。"""
+        threading.Thread(target=self.start, args=(restart,), daemon=True).start()
+
+    def stop(self):
+        """子プロセスを終了する"""
+        with self.lock:
+            self.stopped = True # 明示的に止めた場合は起動し直さない
+            if self.process is None:
+                return
+            try:
+                self.conn.send(None)
+            except Exception:
+                pass
+            self.process.join(timeout=2)
+            self._close()
+            logger.info("recognition process stopped.")
+
+    def _close(self):
+        """子プロセスとパイプを片付ける。lockを取得した状態で呼ぶ。"""
+        if (self.process is not None) and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=1)
+        if self.conn is not None:
+            self.conn.close()
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.sent_revision = None
+
+    def request(self, msg, wait:bool=True):
+        """子プロセスにメッセージを送り、wait=Trueの場合は返答を返す。
+        失敗した場合はNoneを返す。タイムアウトや通信エラーの場合は子プロセスを片付ける(recognize()で起動し直す)。"""
+        with self.lock:
+            if not (self.is_running and self.ready):
+                return None
+            try:
+                self.conn.send(msg)
+                if not wait:
+                    return True
+                if self.conn.poll(self.timeout):
+                    ret = self.conn.recv()
+                    if ret[0] != 'error':
+                        return ret
+                    logger.error(f"error in recognition process:\n{ret[1]}")
+                    return None # 子プロセスは動き続けているので作り直さない
+                logger.error("recognition process timed out.")
+            except Exception:
+                logger.error(traceback.format_exc())
+            self._close() # 返答の順序がずれないように作り直す
+            return None
+
+    def recognize(self, payload:str, source_size, revision:int, recognition_settings:dict) -> tuple:
+        """子プロセスでフレームを判定する
+
+        Args:
+            payload (str): GetSourceScreenshotのimage_data(base64)
+            source_size (tuple): 縮小してキャプチャした場合、元の大きさ(width, height)
+            revision (int): 判定条件のrevision(ImageRecognitionData.revision)
+            recognition_settings (dict): 判定条件(Config.recognition_settings)。revisionが変わった時だけ送る。
+
+        Returns:
+            tuple: (判定できたか, 画面タイプ)。子プロセスを使えない場合や準備中の場合は(False, None)。
+        """
+        if (not self.is_running) and (not self.starting) and (not self.stopped) and ((self.last_start_time is None) or (time.time() - self.last_start_time >= self.restart_interval)):
+            self.start_async(restart=True)
+        if not self.ready:
+            return False, None
+        if revision != self.sent_revision:
+            if self.request(('conditions', revision, dict(recognition_settings)), wait=False) is None:
+                return False, None
+            self.sent_revision = revision
+        ret = self.request(('frame', payload, source_size))
+        if ret is None:
+            return False, None
+        return True, ret[1]
+
+    def get_metrics(self):
+        """子プロセスのFrameChangeDetector.get_metrics()を返す。使えない場合はNone。"""
+        ret = self.request(('metrics',))
+        return None if ret is None else ret[1]
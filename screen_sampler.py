@@ -0,0 +1,141 @@
+# 画面認識のキャプチャ間隔の制御
+import os
+import time
+import threading
+from collections import deque
+
+import logging, logging.handlers
+os.makedirs('log', exist_ok=True)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+hdl = logging.handlers.RotatingFileHandler(
+    f'log/{os.path.basename(__file__).split(".")[0]}.log',
+    encoding='utf-8',
+    maxBytes=1024*1024*2,
+    backupCount=1,
+)
+hdl.setLevel(logging.DEBUG)
+hdl_formatter = logging.Formatter('%(asctime)s %(filename)s:%(lineno)5d %(funcName)s() [%(levelname)s] %(message)s')
+hdl.setFormatter(hdl_formatter)
+logger.addHandler(hdl)
+
+class ScreenSampler:
+    """ゲーム状態に応じて画面認識のキャプチャ間隔を決めるクラス。
+    状態が変わった直後やリザルト画面(すぐ選曲画面に戻る)では細かく、プレー中は粗くキャプチャする。
+    プレー画面→リザルト画面の遷移はdbfileの更新で分かるので、プレー中はnotify_result()で起こされるまで待てばよい。
+    キャプチャ頻度と、画面遷移からトリガー実行までの遅延をget_metrics()で返す。
+    """
+    def __init__(self, fast_interval:float=0.15, select_interval:float=0.5, play_interval:float=2.0, idle_interval:float=1.0,
+                 fast_window:float=3.0, result_window:float=30.0, metrics_window:float=60.0):
+        """
+        Args:
+            fast_interval (float, optional): 遷移が起きそうな時のキャプチャ間隔。 Defaults to 0.15.
+            select_interval (float, optional): 選曲画面でのキャプチャ間隔。 Defaults to 0.5.
+            play_interval (float, optional): プレー画面でのキャプチャ間隔。 Defaults to 2.0.
+            idle_interval (float, optional): 状態が分からない時のキャプチャ間隔。 Defaults to 1.0.
+            fast_window (float, optional): 状態が変わってからこの秒数はfast_intervalでキャプチャする。 Defaults to 3.0.
+            result_window (float, optional): リザルト画面になってからこの秒数はfast_intervalでキャプチャする。 Defaults to 30.0.
+            metrics_window (float, optional): キャプチャ頻度を求める期間。 Defaults to 60.0.
+        """
+        self.fast_interval = fast_interval
+        self.select_interval = select_interval
+        self.play_interval = play_interval
+        self.idle_interval = idle_interval
+        self.fast_window = fast_window
+        self.result_window = result_window
+        self.metrics_window = metrics_window
+        self.state = None
+        self.state_since = time.time() # stateになった時刻
+        self.prev_sample_time = None # 1つ前のキャプチャ時刻
+        self.sample_time = None # 最新のキャプチャ時刻
+        self.result_signal_time = None # dbfileの更新でリザルトを検知した時刻
+        self.pending = False # 状態の変化を観測し、確定待ちの場合True(GameStateFilter.pending)
+        self.sample_times = deque() # metrics_window秒以内のキャプチャ時刻
+        self.latencies = deque(maxlen=100) # 画面遷移からトリガー実行までの時間
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+
+    def next_interval(self, now:float=None) -> float:
+        """現在の状態に応じた次のキャプチャまでの秒数を返す"""
+        now = time.time() if now is None else now
+        elapsed = now - self.state_since
+        if self.pending:
+            return self.fast_interval # 状態の変化を確定させるため続けてキャプチャする
+        if self.state == 'play' and self.result_signal_time is not None and self.result_signal_time >= self.state_since:
+            return self.fast_interval # リザルトが書き込まれたのにまだプレー画面と判定している
+        if elapsed < self.fast_window:
+            return self.fast_interval
+        if self.state == 'result':
+            return self.fast_interval if elapsed < self.result_window else self.select_interval
+        if self.state == 'select':
+            return self.select_interval
+        if self.state == 'play':
+            return self.play_interval
+        return self.idle_interval
+
+    def wait(self, interval:float=None) -> bool:
+        """次のキャプチャまで待つ。notify_result()が呼ばれた場合はすぐに戻る。
+
+        Args:
+            interval (float, optional): 待ち時間。Noneの場合はnext_interval()を使う。 Defaults to None.
+
+        Returns:
+            bool: notify_result()で起こされた場合True
+        """
+        ret = self.wakeup.wait(self.next_interval() if interval is None else interval)
+        self.wakeup.clear()
+        return ret
+
+    def begin_sample(self, now:float=None):
+        """キャプチャ開始時に呼ぶ"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.prev_sample_time = self.sample_time
+            self.sample_time = now
+            self.sample_times.append(now)
+            while self.sample_times and self.sample_times[0] < now - self.metrics_window:
+                self.sample_times.popleft()
+
+    def on_transition(self, old_state, new_state, now:float=None):
+        """状態の変化を検知し、トリガーを実行し終えた時に呼ぶ。
+        遷移した時刻は、1つ前のキャプチャと今回のキャプチャの中間とみなす(dbfileでリザルトを検知していればその時刻)。
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if (self.prev_sample_time is None) or (self.sample_time is None):
+                changed_at = self.sample_time
+            else:
+                changed_at = (self.prev_sample_time + self.sample_time) / 2
+                if new_state == 'result' and self.result_signal_time is not None and self.prev_sample_time <= self.result_signal_time <= self.sample_time:
+                    changed_at = self.result_signal_time
+            if changed_at is not None:
+                self.latencies.append(now - changed_at)
+            self.state = new_state
+            self.state_since = now
+        metrics = self.get_metrics()
+        logger.info(f"{old_state} -> {new_state}, latency:{self.latencies[-1] if self.latencies else 0:.3f}s, rate:{metrics['rate']:.2f}Hz, latency avg:{metrics['latency_avg']:.3f}s, max:{metrics['latency_max']:.3f}s")
+
+    def notify_result(self, now:float=None):
+        """dbfileの更新でリザルトを検知した時に呼ぶ。待機中のキャプチャをすぐに行う。"""
+        self.result_signal_time = time.time() if now is None else now
+        self.wakeup.set()
+
+    def get_metrics(self) -> dict:
+        """キャプチャ頻度と遷移の遅延を返す
+
+        Returns:
+            dict: {'rate':直近metrics_window秒の平均キャプチャ頻度(Hz), 'interval':現在のキャプチャ間隔, 'latency_avg':遅延の平均, 'latency_max':遅延の最大, 'transitions':遅延を計測した遷移の数}
+        """
+        with self.lock:
+            if len(self.sample_times) >= 2:
+                rate = (len(self.sample_times)-1) / max(self.sample_times[-1] - self.sample_times[0], 1e-6)
+            else:
+                rate = 0.0
+            latencies = list(self.latencies)
+        return {
+            'rate':rate,
+            'interval':self.next_interval(),
+            'latency_avg':sum(latencies)/len(latencies) if latencies else 0.0,
+            'latency_max':max(latencies) if latencies else 0.0,
+            'transitions':len(latencies),
+        }
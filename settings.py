@@ -5,10 +5,11 @@ from config import Config
 # from tooltip import ToolTip
 
 class SettingsWindow:
-    def __init__(self, parent, config, on_close_callback=None):
+    def __init__(self, parent, config, on_close_callback=None, manage_results=None):
         self.parent = parent
         self.config = config
         self.on_close_callback = on_close_callback
+        self.manage_results = manage_results # 過去ログ取得で使う、メインウィンドウのManageResults
         
         # ウィンドウ設定
         self.window = tk.Toplevel(parent)
@@ -31,6 +32,8 @@ class SettingsWindow:
         self.enable_folder_updates_var = tk.BooleanVar(value=self.config.enable_folder_updates)
         self.autoload_offset_var = tk.IntVar(value=self.config.autoload_offset)
         self.enable_register_conditions_var = tk.BooleanVar(value=self.config.enable_register_conditions)
+        self.enable_overlay_server_var = tk.BooleanVar(value=self.config.enable_overlay_server)
+        self.overlay_server_port_var = tk.IntVar(value=self.config.overlay_server_port)
         self.nglist_vars = {}
         self.nglist_checkbuttons = {}
         
@@ -158,6 +161,24 @@ class SettingsWindow:
             self.websocket_port_entry, 
             self.websocket_password_entry
         ]
+
+        # overlay配信設定セクション
+        overlay_frame = ttk.LabelFrame(self.scrollable_frame, text="overlay配信設定", padding="10")
+        overlay_frame.pack(fill=tk.X, pady=(0, 15))
+
+        self.enable_overlay_server_cb = ttk.Checkbutton(
+            overlay_frame, 
+            text="HTTPサーバからoverlayを配信する(http://localhost:ポート/info.html などで開く)",
+            variable=self.enable_overlay_server_var,
+        )
+        self.enable_overlay_server_cb.pack(anchor=tk.W, pady=(0, 10))
+
+        overlay_port_frame = ttk.Frame(overlay_frame)
+        overlay_port_frame.pack(fill=tk.X, pady=2)
+
+        ttk.Label(overlay_port_frame, text="ポート:", width=12).pack(side=tk.LEFT)
+        self.overlay_server_port_entry = ttk.Entry(overlay_port_frame, textvariable=self.overlay_server_port_var, width=10)
+        self.overlay_server_port_entry.pack(side=tk.LEFT, padx=(5, 0))
     
         # 難易度表セクションを初期化
         self.setup_ui_nglist()
@@ -381,7 +402,8 @@ class SettingsWindow:
         temp_config.player_path = self.player_path_var.get()
         temp_config.autoload_offset = self.autoload_offset_var.get()
 
-        acc = DataBaseAccessor()
+        # playlogを書くのはメインウィンドウのManageResultsだけにする(別インスタンスだとjournalのcompactionで互いの追記を消してしまう)
+        acc = DataBaseAccessor(manage_results=self.manage_results)
         acc.set_config(temp_config)
         acc.read_old_results()
         acc.manage_results.save()
@@ -398,6 +420,15 @@ class SettingsWindow:
             messagebox.showerror("入力エラー", "ポート番号は数値で入力してください。")
             return False
         
+        try:
+            port = self.overlay_server_port_var.get()
+            if port < 1 or port > 65535:
+                messagebox.showerror("入力エラー", "ポート番号は1-65535の範囲で入力してください。")
+                return False
+        except tk.TclError:
+            messagebox.showerror("入力エラー", "ポート番号は数値で入力してください。")
+            return False
+
         # ホスト名の基本チェック
         if self.enable_websocket_var.get():
             host = self.websocket_host_var.get().strip()
@@ -425,6 +456,8 @@ class SettingsWindow:
             self.config.enable_folder_updates = self.enable_folder_updates_var.get()
             self.config.autoload_offset = self.autoload_offset_var.get()
             self.config.enable_register_conditions = self.enable_register_conditions_var.get()
+            self.config.enable_overlay_server = self.enable_overlay_server_var.get()
+            self.config.overlay_server_port = self.overlay_server_port_var.get()
 
             # 難易度表設定を保存
             self.config.difftable_nglist = []
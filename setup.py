@@ -52,6 +52,11 @@ build_exe_options = {
         "config",
         "dataclass",
         "obs_control",
+        "file_watcher",
+        "overlay_server",
+        "screen_sampler",
+        "state_filter",
+        "recognition_process",
         "pickle_converter",
         "tooltip",
         "settings",
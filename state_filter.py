@@ -0,0 +1,130 @@
+# 画面認識結果の時間方向のフィルタ
+import os
+import time
+import inspect
+from collections import deque
+
+import logging, logging.handlers
+os.makedirs('log', exist_ok=True)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+hdl = logging.handlers.RotatingFileHandler(
+    f'log/{os.path.basename(__file__).split(".")[0]}.log',
+    encoding='utf-8',
+    maxBytes=1024*1024*2,
+    backupCount=1,
+)
+hdl.setLevel(logging.DEBUG)
+hdl_formatter = logging.Formatter('%(asctime)s %(filename)s:%(lineno)5d %(funcName)s() [%(levelname)s] %(message)s')
+hdl.setFormatter(hdl_formatter)
+logger.addHandler(hdl)
+
+class GameStateFilter:
+    """1フレームごとの画面認識結果から、ゲーム状態の遷移を確定させるクラス。
+    フェードやロード画面、しきい値付近のハッシュによるちらつきでトリガーが連発しないようにする。
+
+    - 直近window_sizeフレームのうちmin_countフレーム以上が同じ状態で、かつ最新フレームもその状態なら候補とする
+    - 現在の状態になってからmin_dwell秒経つまでは遷移しない
+    - transitionsに無い遷移は、候補がforce_after秒続いた場合のみ受け入れる(画面の見逃しで止まらないようにするため)
+    - どの画面にもマッチしない(None)状態へは、unknown_after秒続いた場合のみ遷移する
+    """
+    DEFAULT_TRANSITIONS = {
+        None:     ('select', 'play', 'result'),
+        'select': ('play',),
+        'play':   ('result',),
+        'result': ('select',),
+    }
+
+    def __init__(self, window_size:int=4, min_count:int=3, min_dwell:dict=None, transitions:dict=None,
+                 force_after:float=5.0, unknown_after:float=10.0):
+        """
+        Args:
+            window_size (int, optional): 判定に使う直近のフレーム数(M)。 Defaults to 4.
+            min_count (int, optional): 遷移に必要なフレーム数(N)。 Defaults to 3.
+            min_dwell (dict, optional): 状態ごとの最短滞在時間(秒)。 Defaults to {'select':1.0, 'play':5.0, 'result':1.0}.
+            transitions (dict, optional): 状態 -> 遷移先の一覧。 Defaults to DEFAULT_TRANSITIONS.
+            force_after (float, optional): transitionsに無い遷移を受け入れるまでの秒数。 Defaults to 5.0.
+            unknown_after (float, optional): Noneへ遷移するまでの秒数。 Defaults to 10.0.
+        """
+        self.window_size = window_size
+        self.min_count = min(min_count, window_size)
+        self.min_dwell = {'select':1.0, 'play':5.0, 'result':1.0} if min_dwell is None else min_dwell
+        self.transitions = self.DEFAULT_TRANSITIONS if transitions is None else transitions
+        self.force_after = force_after
+        self.unknown_after = unknown_after
+        self.frames = deque(maxlen=window_size)
+        self.state = None
+        self.state_since = None
+        self.candidate = None # 遷移先の候補
+        self.candidate_since = None # 候補が最新フレームで続いている最初の時刻(候補が無い場合None)
+
+    @classmethod
+    def from_settings(cls, settings:dict):
+        """Config.state_filter_settingsから作成する。遷移はlistで保存されているのでtupleに直す。
+        古い設定ファイルなどに含まれる未知のキーは無視する。"""
+        params = inspect.signature(cls.__init__).parameters
+        settings = dict(settings or {})
+        unknown = [k for k in settings if (k == 'self') or (k not in params)]
+        if unknown:
+            logger.warning(f"ignored unknown settings: {unknown}")
+            for k in unknown:
+                settings.pop(k)
+        if 'transitions' in settings:
+            settings['transitions'] = {(None if k in ('None', '') else k):tuple(v) for k,v in settings['transitions'].items()}
+        return cls(**settings)
+
+    @property
+    def pending(self) -> bool:
+        """現在と異なる状態のフレームが観測され、確定待ちの場合True"""
+        return self.candidate_since is not None
+
+    def is_allowed(self, old_state, new_state) -> bool:
+        return new_state in self.transitions.get(old_state, ())
+
+    def update(self, raw_state, now:float=None):
+        """1フレーム分の認識結果を入力する
+
+        Args:
+            raw_state (str): そのフレームの認識結果('select', 'play', 'result', None)
+            now (float, optional): フレームの時刻。 Defaults to None.
+
+        Returns:
+            tuple: 遷移が確定した場合(前の状態, 新しい状態)。それ以外はNone。
+        """
+        now = time.time() if now is None else now
+        if self.state_since is None:
+            self.state_since = now
+        self.frames.append(raw_state)
+
+        if raw_state == self.state:
+            self.candidate = self.candidate_since = None
+            return None
+        if (self.candidate_since is None) or (raw_state != self.candidate):
+            self.candidate = raw_state
+            self.candidate_since = now
+        duration = now - self.candidate_since
+
+        if raw_state is None:
+            ok = duration >= self.unknown_after
+        else:
+            ok = sum(1 for f in self.frames if f == raw_state) >= self.min_count
+            ok = ok and (now - self.state_since >= self.min_dwell.get(self.state, 0))
+            if ok and not self.is_allowed(self.state, raw_state):
+                ok = duration >= self.force_after
+                if ok:
+                    logger.info(f"forced transition: {self.state} -> {raw_state}")
+        if not ok:
+            return None
+
+        ret = (self.state, raw_state)
+        self.state = raw_state
+        self.state_since = now
+        self.candidate = self.candidate_since = None
+        return ret
+
+    def reset(self, state=None, now:float=None):
+        """状態を初期化する"""
+        self.frames.clear()
+        self.state = state
+        self.state_since = time.time() if now is None else now
+        self.candidate = self.candidate_since = None